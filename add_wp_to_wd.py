@@ -13,14 +13,16 @@ import json
 import sys
 import os
 
+import kajlib as lib
+
 def process_wd_personer(input_spreadsheet):
     # Verify that the input sheet exists
     input_tab = "wd-personer"
     prio_tab = "wd-personer-prioritet"
     places_tab = "wd-place"
     print(f"add_wp_to_wd: Verifying {input_spreadsheet}")
-    xl = pd.ExcelFile(input_spreadsheet)
-    sheet_names = xl.sheet_names
+    workbook = lib.Workbook(input_spreadsheet)
+    sheet_names = workbook.sheet_names
     if not input_tab in sheet_names:
         print(f"add_wp_to_wd.py error: Could not find sheet {input_tab}' in file "
               f"{input_spreadsheet}")
@@ -35,9 +37,9 @@ def process_wd_personer(input_spreadsheet):
         sys.exit(0)
 
     print(f"add_wp_to_wd: reading {input_spreadsheet} / {input_tab}")
-    df_personer = pd.read_excel(input_spreadsheet, sheet_name=input_tab)
+    df_personer = workbook.sheet(input_tab)
     print(f"add_wp_to_wd: reading {input_spreadsheet} / {prio_tab}")
-    df_prio = pd.read_excel(input_spreadsheet, sheet_name=prio_tab)
+    df_prio = workbook.sheet(prio_tab)
 
     print(f"add_wp_to_wd: condensing {input_tab} by occupation")
     # Add 'prio' column (for occupation priority) to df_personer
@@ -71,7 +73,7 @@ def process_wd_personer(input_spreadsheet):
     del df_personer['prio']
 
     print(f"add_wp_to_wd: reading {input_spreadsheet} / {places_tab}")
-    df_places = pd.read_excel(input_spreadsheet, sheet_name=places_tab)
+    df_places = workbook.sheet(places_tab)
     df_places = df_places.replace(np.nan, '', regex=True)
     levels_by_place= {}
     for i, row in df_places.iterrows():
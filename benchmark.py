@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+
+"""
+Scaling benchmark of the Voronoi layout and SVG pipeline on synthetic data
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import kajlib as lib
+import voronoi
+
+SHAPES = {
+    # Like kajdisk_pic_2019.csv: hier1..3 folders with their dirs, files
+    # and bytes; bytes as area, files as quality
+    'disk': {'levels': ['hier1', 'hier2', 'hier3'], 'fanout': [20, 25, 20],
+             'area': 'bytes', 'quality': 'files', 'quality_range': (1, 1000),
+             'counts': ['dirs']},
+    # Like finlandssvenskar.csv: tid/kon/ort/namn, rader as area, arh
+    # (century) as quality
+    'fs': {'levels': ['tid', 'kon', 'ort', 'namn'], 'fanout': [6, 2, 200, 0],
+           'area': 'rader', 'quality': 'arh', 'quality_range': (17, 21),
+           'counts': []},
+}
+
+BORDERS = [{'rule': '<5', 'bg_color': '#469664', 'fg_color': 'white'},
+           {'rule': '<50', 'bg_color': '#32c882', 'fg_color': ''},
+           {'rule': '<500', 'bg_color': '#ff8c00', 'fg_color': ''},
+           {'rule': '', 'bg_color': '#ffd200', 'fg_color': ''}]
+
+
+def skewed_choice(rng, n, rows, skew):
+    """rows draws among n values, Zipf-like with exponent skew (0 = even)"""
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return rng.choice(n, size=rows, p=weights / weights.sum())
+
+
+def synthetic(shape, rows, depth=None, skew=1.0, seed=0):
+    """
+    Synthetic hierarchy shaped like one of SHAPES
+    :param depth: number of levels (default: as the shape); extra levels
+        go before the last one, with the fanout of the last folder level
+    :param skew: Zipf exponent of the level values and the area sizes
+    :return: dict of columns (NumPy arrays, named as in the shape), levels,
+        area and quality
+    """
+    spec = SHAPES[shape]
+    rng = np.random.default_rng(seed)
+    fanout = list(spec['fanout'])
+    levels = list(spec['levels'])
+    depth = depth or len(fanout)
+    while len(fanout) < depth:  # The last level stays last, by its name
+        fanout.insert(-1, fanout[-2] if len(fanout) > 1 else 20)
+        levels.insert(-1, "level%s" % len(levels))
+    fanout = fanout[:depth]
+    levels = levels[:depth]
+    columns = {}
+    for level, n in zip(levels, fanout):
+        if n == 0:  # One name per row, as namn
+            columns[level] = np.char.add("n", np.arange(rows).astype(str))
+        else:
+            codes = skewed_choice(rng, n, rows, skew)
+            columns[level] = np.char.add(level + "_", codes.astype(str))
+    columns[spec['area']] = np.floor(rng.pareto(max(skew, 0.1) + 0.5, rows) *
+                                     1000 + 1)
+    low, high = spec['quality_range']
+    columns[spec['quality']] = rng.integers(low, high, rows).astype(float)
+    for count in spec['counts']:  # Not drawn, but part of the data
+        columns[count] = rng.integers(1, 10, rows)
+    return {'columns': columns, 'levels': levels, 'area': spec['area'],
+            'quality': spec['quality']}
+
+
+def run_case(data, output_file):
+    """
+    Render all diagrams of one synthetic hierarchy with voronoi.render(),
+    timing its stages with the spans of kajlib.tracer
+    :return: dict of stage times (s), cell counts and output bytes
+    """
+    enabled = lib.tracer.enabled
+    lib.tracer.drain()
+    lib.tracer.enable()
+    t0 = time.perf_counter()
+    try:
+        rendering = voronoi.render(data['columns'], data['levels'],
+                                   data['area'], data['quality'], BORDERS,
+                                   output=output_file)
+    finally:
+        total = time.perf_counter() - t0
+        events, counters = lib.tracer.drain()
+        lib.tracer.enable(enabled)
+    spans = {}
+    for phase, name, start, dur, depth, pid, value in events:
+        if phase == 'X':
+            spans[name] = spans.get(name, 0) + dur / 1e9
+    result = {'total_s': total, 'layout_s': spans.get('layout', 0.0),
+              'svg_s': spans.get('paint', 0.0) + spans.get('write', 0.0)}
+    # Aggregation into the index and setting up the page
+    result['index_s'] = total - result['layout_s'] - result['svg_s']
+    result['cells'] = [len(cells) for cells in rendering.diagrams]
+    result['output_bytes'] = os.path.getsize(output_file)
+    return result
+
+
+def peak_memory(data, output_file):
+    """Peak traced Python/NumPy memory (bytes) of run_case()"""
+    tracemalloc.start()
+    try:
+        run_case(data, output_file)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma separated row counts")
+    parser.add_argument("--shapes", default=",".join(SHAPES),
+                        help="comma separated shapes, of %s" % list(SHAPES))
+    parser.add_argument("--depths", default="",
+                        help="comma separated level counts (default: the "
+                             "depth of each shape)")
+    parser.add_argument("--skews", default="1.0",
+                        help="comma separated Zipf exponents of the data")
+    parser.add_argument("--format", default="svg",
+                        choices=["svg", "svgz", "png"],
+                        help="output written per case (default svg)")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the (slower) tracemalloc pass")
+    parser.add_argument("--output", "-o", default="benchmark.json",
+                        help="JSON result file (default benchmark.json)")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    shapes = args.shapes.split(",")
+    depths = [int(d) for d in args.depths.split(",") if d] or [None]
+    skews = [float(s) for s in args.skews.split(",")]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        output_file = os.path.join(tmp, "benchmark." + args.format)
+        for shape in shapes:
+            for depth in depths:
+                for skew in skews:
+                    for rows in sizes:
+                        data = synthetic(shape, rows, depth, skew)
+                        result = {'shape': shape, 'rows': rows,
+                                  'depth': len(data['levels']),
+                                  'skew': skew, 'format': args.format}
+                        result.update(run_case(data, output_file))
+                        if not args.no_memory:
+                            result['peak_bytes'] = peak_memory(data,
+                                                               output_file)
+                        results.append(result)
+                        print(f"{shape} rows {rows} depth {result['depth']} "
+                              f"skew {skew}: index {result['index_s']:.3f} s"
+                              f" layout {result['layout_s']:.3f} s "
+                              f"svg {result['svg_s']:.3f} s, "
+                              f"{result['cells'][-1]} cells, "
+                              f"{result['output_bytes']} bytes"
+                              + (f", peak {result['peak_bytes']} bytes"
+                                 if 'peak_bytes' in result else ""))
+
+    report = {'created': datetime.datetime.now().isoformat(),
+              'commit': git_commit(),
+              'python': sys.version.split()[0],
+              'numpy': np.__version__,
+              'machine': platform.platform(),
+              'results': results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"benchmark.py: {len(results)} results saved into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
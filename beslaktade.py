@@ -13,19 +13,21 @@ import json
 import sys
 import os
 
+import kajlib as lib
+
 def process_corpus(input_spreadsheet):
     # Verify that the input sheet exists
     input_tab = "core_corpus"
     print(f"beslaktade: Verifying {input_spreadsheet}")
-    xl = pd.ExcelFile(input_spreadsheet)
-    sheet_names = xl.sheet_names
+    workbook = lib.Workbook(input_spreadsheet)
+    sheet_names = workbook.sheet_names
     if not input_tab in sheet_names:
         print(f"add_wp_to_wd.py error: Could not find sheet {input_tab}' in file "
               f"{input_spreadsheet}")
         sys.exit(0)
 
     print(f"add_wp_to_wd: reading {input_spreadsheet} / {input_tab}")
-    df_personer = pd.read_excel(input_spreadsheet, sheet_name=input_tab)
+    df_personer = workbook.sheet(input_tab)
     df_personer['person'] = np.arange(len(df_personer))
     df_personer['person'] = df_personer['person'].astype(str)
     return df_personer
@@ -10,10 +10,16 @@ from collections import namedtuple
 
 import datetime
 import codecs
+import contextlib
 import sys
 import errno
+import gzip
 import os
 import csv
+import hashlib
+import importlib.util
+import json
+import time
 
 import kajfmt as fmt
 import kajhtml
@@ -22,32 +28,168 @@ from kajhtml import td, tdr, th, thr
 
 _debug_object = kajhtml.HTML
 
+class _NullSpan(object):
+    """Span of a disabled Tracer: does nothing, shared by all calls"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.tracer.depth += 1
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        tracer = self.tracer
+        tracer.depth -= 1
+        tracer.events.append(('X', self.name, self.start, end - self.start,
+                              tracer.depth, os.getpid(), self.args))
+        return False
+
+
+class Tracer(object):
+    """
+    Nested timing spans and counters on the monotonic perf_counter_ns clock
+
+    Disabled (the default), span() hands out one shared no-op context
+    manager and count() returns at once, so instrumented code costs next to
+    nothing. Enabled, the events can be written as a Chrome trace-event
+    JSON file (chrome://tracing, Perfetto) or summarised as a text report.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []  # (phase, name, start ns, duration ns, depth, pid,
+                          #  args or counter value)
+        self.counters = {}
+        self.depth = 0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def span(self, name, **args):
+        """Context manager timing one span (nested spans nest in the trace)"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def count(self, name, value=1):
+        """Add value to counter name (cells, splits, bytes, ...)"""
+        if not self.enabled:
+            return
+        total = self.counters.get(name, 0) + value
+        self.counters[name] = total
+        self.events.append(('C', name, time.perf_counter_ns(), 0, self.depth,
+                            os.getpid(), total))
+
+    def instant(self, name, **args):
+        """Event without duration"""
+        if not self.enabled:
+            return
+        self.events.append(('i', name, time.perf_counter_ns(), 0, self.depth,
+                            os.getpid(), args))
+
+    def drain(self):
+        """Hand over (and forget) the events and counters so far, e.g. from
+        a worker process to the main one"""
+        drained = (self.events, self.counters)
+        self.events = []
+        self.counters = {}
+        return drained
+
+    def extend(self, drained):
+        """Add the events and counters drained from another Tracer"""
+        events, counters = drained
+        self.events.extend(events)
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def chrome_trace(self):
+        """The events in Chrome trace-event format (times in us)"""
+        trace = []
+        for phase, name, start, dur, depth, pid, value in self.events:
+            event = {'name': name, 'ph': phase, 'ts': start / 1000.0,
+                     'pid': pid, 'tid': pid}
+            if phase == 'X':
+                event['dur'] = dur / 1000.0
+                event['args'] = value
+            elif phase == 'C':
+                event['args'] = {name: value}
+            else:
+                event['s'] = 'p'
+                event['args'] = value
+            trace.append(event)
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def report(self):
+        """Text report: calls and time per span name, and the counters"""
+        spans = {}
+        for phase, name, start, dur, depth, pid, value in self.events:
+            if phase == 'X':
+                first, calls, total, min_depth = spans.get(
+                    name, (start, 0, 0, depth))
+                spans[name] = (min(first, start), calls + 1, total + dur,
+                               min(min_depth, depth))
+        s = "Trace report\n"
+        for name in sorted(spans, key=lambda name: spans[name][0]):
+            first, calls, total, depth = spans[name]
+            s += "%s%s: %s calls, %.3f ms\n" % ("  " * depth, name, calls,
+                                                total / 1e6)
+        for name, value in self.counters.items():
+            s += "%s: %s\n" % (name, i1000(value))
+        return s
+
+
+tracer = Tracer()
+
+
 def start_log(debug_object, text=""):
+    """Start the text log; its events and the calls of logged() functions
+    also go into tracer, if the caller has enabled it (and drains it)"""
     now = datetime.datetime.now()
-    print("start_log %s" % now)
     global _log, _debug_object
     _debug_object = debug_object
+    start = time.perf_counter()
     _log = {'stack': [], 'object': _debug_object, 'text': text,
-            'start_time': now, 'last_time': now}
+            'start_date': now, 'start_time': start, 'last_time': start}
     _log['stack'].append("%s\n%s: start %s" % (now.date(), now.time(), text))
 
 
 def log_event(text, count=None, decorated=False):
     if decorated and _log.get('object') != _debug_object:
         return
-    current = datetime.datetime.now()
-    resp = str(current - _log['start_time'])
-    print("log_event %s - %s" % (current, resp))
-    delta = current - _log['last_time']
+    current = time.perf_counter()
+    delta = datetime.timedelta(seconds=current - _log['last_time'])
     count_text = " (%s)" % count if count is not None else ""
     _log['last_time'] = current
     _log['stack'].append("+%s%s: %s" % (str(delta), count_text, text))
+    tracer.instant(text, count=count)
 
 
 def response_time():
     log_event("End")
-    print("from %s to %s" % (_log['start_time'], _log['last_time']))
-    return str(_log['last_time'] - _log['start_time'])
+    elapsed = datetime.timedelta(seconds=_log['last_time'] -
+                                 _log['start_time'])
+    print("from %s to %s" % (_log['start_date'], _log['start_date'] + elapsed))
+    return str(elapsed)
 
 
 def log_rpt():
@@ -72,7 +214,8 @@ def logged(func):
         if args[0].__class__.__name__ != _debug_object:
             return func(*args, **kwargs)
         log_event(func.__name__ + " start", decorated=True)
-        result = func(*args, **kwargs)
+        with tracer.span(func.__name__):
+            result = func(*args, **kwargs)
         log_event(func.__name__ + " end", decorated=True)
         return result
     return wrapper
@@ -109,13 +252,41 @@ def ensure_dir(dir_name):
             raise
 
 
+def temp_filename(filename):
+    """Temporary file next to filename, to write it in before it replaces
+    filename (per process, so that workers do not clash)"""
+    return "%s.%s.tmp" % (filename, os.getpid())
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="w", **kwargs):
+    """
+    Open a temporary file for writing filename: it replaces filename when
+    the with block ends, or is removed if the block fails, so that readers
+    never see a half-written file
+    """
+    temp = temp_filename(filename)
+    try:
+        with open(temp, mode, **kwargs) as f:
+            yield f
+        os.replace(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
 def save_as(filename, a_str, verbose=False):
+    """Save a_str as UTF-8 into filename, gzip compressed if it ends .svgz"""
     a_unicode = a_str
     if sys.version_info < (3,):
         if type(a_str) is str:
             a_unicode = unicode(a_str, "utf-8")
 
-    with codecs.open(filename, "w", "utf8") as f:
+    if filename.endswith(".svgz"):
+        open_ = lambda: gzip.open(filename, "wt", encoding="utf8")
+    else:
+        open_ = lambda: codecs.open(filename, "w", "utf8")
+    with open_() as f:
         val = f.write(a_unicode)
         if verbose:
             chars = i1000((len(a_str)))
@@ -431,3 +602,273 @@ class Report(object):
             s += " %s" % row
         return s
 
+
+def prune_cache(dir_, extensions, max_age_days, max_bytes):
+    """
+    Evict the files of a cache folder ending in one of extensions: those
+    older than max_age_days, then the least recently used ones until the
+    rest is below max_bytes. Files that vanish meanwhile (pruned by
+    another process) are skipped.
+    :return: number of files removed
+    """
+    files = []
+    for name in os.listdir(dir_):
+        path = os.path.join(dir_, name)
+        if name.endswith(extensions):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort(reverse=True)  # Most recently used first
+    oldest_allowed = time.time() - max_age_days * 24 * 3600
+    total = 0
+    removed = 0
+    for mtime, size, path in files:
+        total += size
+        if mtime < oldest_allowed or total > max_bytes:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+    return removed
+
+
+class SheetCache(object):
+    """
+    On-disk cache of parsed spreadsheet sheets, as Arrow (Feather) files
+
+    A sheet is stored under a key made of the workbook's absolute path,
+    modification time and size, the sheet name and the columns read, so
+    any change to the workbook simply misses the cache. The cache needs
+    pyarrow (see available()); sheets Arrow cannot hold are not cached.
+    Reading refreshes a file's time stamp; prune() evicts files older than
+    max_age_days and then the least recently used ones until the cache is
+    below max_bytes.
+
+    The cache is transparent: a cache folder that cannot be read or
+    written only means that sheets are parsed from the workbook again.
+    The constructor raises OSError if the folder cannot be created.
+    """
+
+    def __init__(self, dir_=None, max_age_days=30, max_bytes=1 << 30):
+        if dir_ is None:
+            dir_ = os.environ.get("KAJ_SHEET_CACHE", os.path.join(
+                os.path.expanduser("~"), ".cache", "kajsheets"))
+        self.dir = dir_
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        ensure_dir(self.dir)
+
+    @staticmethod
+    def available():
+        """Is pyarrow, which the Feather files need, installed?"""
+        return importlib.util.find_spec("pyarrow") is not None
+
+    def __str__(self):
+        s = "SheetCache('%s'): max %s days, max %s bytes"
+        return s % (self.dir, self.max_age_days, i1000(self.max_bytes))
+
+    @staticmethod
+    def key(filename, sheet, columns=None):
+        stat = os.stat(filename)
+        columns = None if columns is None else sorted(columns)
+        parts = [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size,
+                 sheet, columns]
+        return hashlib.sha1(json.dumps(parts).encode("utf8")).hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.dir, key + extension)
+
+    def load(self, filename, sheet, columns=None):
+        """The cached sheet as a DataFrame, or None if not cached"""
+        import pandas as pd
+        path = self._path(self.key(filename, sheet, columns), ".feather")
+        try:
+            df = pd.read_feather(path)
+            os.utime(path)
+        except (OSError, ValueError, ImportError):  # Not cached, unreadable
+            return None
+        return df
+
+    def save(self, filename, sheet, df, columns=None):
+        path = self._path(self.key(filename, sheet, columns), ".feather")
+        try:
+            self._write(path, df.to_feather)
+        except Exception:  # Unwritable folder, or columns Arrow cannot type
+            return
+        self.prune()
+
+    @staticmethod
+    def _write(path, write):
+        with atomic_write(path, "wb") as f:
+            write(f)
+
+    def load_names(self, filename):
+        """Cached list of sheet names of the workbook, or None"""
+        path = self._path(self.key(filename, None), ".json")
+        try:
+            with open(path) as f:
+                sheet_names = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return sheet_names
+
+    def save_names(self, filename, sheet_names):
+        def write(f):
+            f.write(json.dumps(sheet_names).encode("utf8"))
+        try:
+            self._write(self._path(self.key(filename, None), ".json"), write)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Evict files by age, then by total size; return files removed
+        (.pkl: left over from earlier versions, which pickled sheets)"""
+        try:
+            return prune_cache(self.dir, (".feather", ".pkl", ".json"),
+                               self.max_age_days, self.max_bytes)
+        except OSError:
+            return 0
+
+
+class Workbook(object):
+    """
+    Spreadsheet file opened once and shared by everything that reads it
+
+    Each sheet is parsed at most once, and only with the columns declared
+    through need() beforehand; values derived from the sheets (cleaned
+    frames, colour dictionaries, ...) can be kept with memo(). Parsed
+    sheets also go to a SheetCache (cache=None: the default one, if
+    pyarrow is installed and the cache folder can be made; False: none),
+    so that later runs on an unchanged file skip parsing.
+    """
+
+    def __init__(self, filename, cache=None):
+        self.filename = filename
+        self._excel_file = None
+        if (cache is None and os.environ.get("KAJ_SHEET_CACHE") != "off"
+                and SheetCache.available()):
+            try:
+                cache = SheetCache()
+            except OSError:  # No usable cache folder: parse every time
+                cache = None
+        self.cache = cache or None
+        self.sheet_names = (self.cache and
+                            self.cache.load_names(filename))
+        if self.sheet_names is None:
+            self.sheet_names = self.excel_file.sheet_names
+            if self.cache:
+                self.cache.save_names(filename, self.sheet_names)
+        self.columns = {}
+        self.frames = {}
+        self.memos = {}
+
+    def __str__(self):
+        s = "Workbook('%s'): %s sheets, %s parsed"
+        return s % (self.filename, len(self.sheet_names), len(self.frames))
+
+    def __getstate__(self):
+        # The open file stays behind when sent to another process
+        state = self.__dict__.copy()
+        state['_excel_file'] = None
+        return state
+
+    @property
+    def excel_file(self):
+        if self._excel_file is None:
+            import pandas as pd  # Only when a spreadsheet is read at all
+            self._excel_file = pd.ExcelFile(self.filename)
+        return self._excel_file
+
+    def need(self, sheet, columns=None):
+        """Declare columns of sheet to be read; None = all columns"""
+        if columns is None or self.columns.get(sheet, set()) is None:
+            self.columns[sheet] = None
+        else:
+            self.columns.setdefault(sheet, set()).update(columns)
+
+    def sheet(self, sheet):
+        """The parsed sheet as a DataFrame (parsed at first call only)"""
+        if sheet not in self.frames:
+            with tracer.span("read sheet", sheet=sheet):
+                self.frames[sheet] = self._read_sheet(sheet)
+        return self.frames[sheet]
+
+    def _read_sheet(self, sheet):
+        """Sheet from the cache, or else parsed from the file"""
+        columns = self.columns.get(sheet)
+        df = None
+        if self.cache:
+            df = self.cache.load(self.filename, sheet, columns)
+        if df is None:
+            usecols = None if columns is None else columns.__contains__
+            df = self.excel_file.parse(sheet, usecols=usecols)
+            if self.cache:
+                self.cache.save(self.filename, sheet, df, columns)
+        return df
+
+    def load(self):
+        """Parse all sheets declared through need(), e.g. before forking"""
+        for sheet in self.columns:
+            if sheet in self.sheet_names:
+                self.sheet(sheet)
+
+    def memo(self, key, function, *args):
+        """function(*args), computed only the first time key is asked for"""
+        if key not in self.memos:
+            self.memos[key] = function(*args)
+        return self.memos[key]
+
+
+class CsvWorkbook(object):
+    """
+    Folder of .csv files used as a Workbook, read with the csv module only,
+    so that no pandas (nor openpyxl) has to be imported
+
+    The file given is the sheet named macro; every other name.csv in its
+    folder is the sheet name. sheet() gives a list of row dicts, with
+    empty cells as "".
+    """
+
+    def __init__(self, filename, macro):
+        self.filename = filename
+        self.macro = macro
+        self.cache = None
+        folder = os.path.dirname(os.path.abspath(filename))
+        self.paths = {macro: filename}
+        for name in sorted(os.listdir(folder)):
+            if (name.lower().endswith(".csv") and
+                    name != os.path.basename(filename)):
+                self.paths.setdefault(name[:-4], os.path.join(folder, name))
+        self.sheet_names = list(self.paths)
+        self.frames = {}
+        self.memos = {}
+
+    def __str__(self):
+        s = "CsvWorkbook('%s'): %s sheets, %s read"
+        return s % (self.filename, len(self.sheet_names), len(self.frames))
+
+    def need(self, sheet, columns=None):
+        """As Workbook.need(); all columns of a .csv file are read anyway"""
+        pass
+
+    def sheet(self, sheet):
+        """The sheet as a list of row dicts (read at first call only)"""
+        if sheet not in self.frames:
+            with tracer.span("read sheet", sheet=sheet):
+                with open(self.paths[sheet], newline="",
+                          encoding="utf-8-sig") as f:
+                    self.frames[sheet] = list(csv.DictReader(f))
+        return self.frames[sheet]
+
+    def load(self):
+        pass
+
+    def memo(self, key, function, *args):
+        """function(*args), computed only the first time key is asked for"""
+        if key not in self.memos:
+            self.memos[key] = function(*args)
+        return self.memos[key]
@@ -5,9 +5,17 @@
 Geodata analysis of tracks; management of placemarks
 """
 
+import gzip
+import io
+import math
+import numbers
 import os.path
+import struct
+import zlib
 from time import strftime
 
+import numpy as np
+
 import kajfmt as fmt
 import kajlib as lib
 
@@ -98,6 +106,64 @@ def merge(dir_, svg_files, filename, prominence=9):
     lib.save_as(demo_filename, contents, True)
 
 
+class SVGFile(object):
+    """
+    Buffered output file for an SVG document written fragment by fragment
+
+    Everything goes to a temporary file next to filename, which replaces
+    filename only on close(), so readers never see a half-written document.
+    Used as a context manager, the temporary file is removed on errors.
+    A filename ending in .svgz is gzip compressed as it is written.
+    """
+
+    def __init__(self, filename, buffer_size=1 << 16, compresslevel=9):
+        self.filename = filename
+        self.temp_filename = lib.temp_filename(filename)
+        if filename.endswith(".svgz"):
+            self.raw = io.open(self.temp_filename, "wb", buffering=buffer_size)
+            gz = gzip.GzipFile(os.path.basename(filename)[:-1], "wb",
+                               compresslevel, self.raw)
+            self.file = io.TextIOWrapper(gz, encoding="utf8")
+        else:
+            self.raw = None
+            self.file = io.open(self.temp_filename, "w", encoding="utf8",
+                                buffering=buffer_size)
+        self.chars = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, fragment):
+        self.file.write(fragment)
+        self.chars += len(fragment)
+
+    def _close_files(self):
+        self.file.close()
+        if self.raw is not None:  # GzipFile leaves its fileobj open
+            self.raw.close()
+
+    def close(self):
+        self._close_files()
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        self._close_files()
+        os.remove(self.temp_filename)
+
+
+# Properties that vary from element to element (a font size per label):
+# in compact mode they stay in the style attribute of the element, and the
+# fixed rest of its style becomes the shared class. Not as presentation
+# attributes, which the text rule of the document CSS would override.
+ELEMENT_PROPERTIES = ('font-size',)
+
+
 class SVG(object):
     """Output class for SVG"""
 
@@ -111,9 +177,22 @@ class SVG(object):
         self.pixels = None
         self.last_within = False
         self.mid_points = []
+        self.compact = False
+        self.precision = 2
+        self.classes = {}
+        self.classes_written = 0
 
         self.set_canvas()
 
+    def set_compact(self, precision=2):
+        """
+        Compact output: each distinct style becomes one shared CSS class
+        (but for the ELEMENT_PROPERTIES), comments are dropped and
+        coordinates rounded to precision decimals
+        """
+        self.compact = True
+        self.precision = precision
+
     def doc_header(self, more_defs=""):
         height = self.canvas['mm']['height']
         width = self.canvas['mm']['width']
@@ -135,27 +214,86 @@ class SVG(object):
           fill: black; stroke: none; }
     polyline, rect {fill: none;}
     * { stroke: black; stroke-width: 0.2; }
-    ]]></style>
+%s    ]]></style>
   <marker id='mid' orient="auto"
     markerWidth='6' markerHeight='12' refX='0.3' refY='3'>
     <path d='M0,0 V6 L3,3 Z'/>
   </marker>
   %s
  </defs>\n""" % (width, height, width, height, self.title, self.desc,
-                 fmt.current_timestamp(), more_defs)
+                 fmt.current_timestamp(), self.css(), more_defs)
+
+    @staticmethod
+    def save_as(filename, fragments, verbose=False):
+        """
+        Stream SVG fragments into filename as they are produced
+        :param fragments: iterable (typically a generator) of strings
+        :return: number of chars saved; 0 = no fragments, no file written
+        """
+        f = SVGFile(filename)
+        try:
+            for fragment in fragments:
+                with lib.tracer.span("write"):
+                    f.write(fragment)
+        except BaseException:
+            f.abort()
+            raise
+        if f.chars == 0:
+            f.abort()
+            return 0
+        with lib.tracer.span("write"):
+            f.close()
+        if lib.tracer.enabled:
+            lib.tracer.count("bytes", os.path.getsize(filename))
+        if verbose:
+            print("%s chars saved into file %s" % (lib.i1000(f.chars),
+                                                   filename))
+        return f.chars
 
     @staticmethod
     def doc_footer(comment=""):
         return "%s\n</svg>" % comment
 
-    @staticmethod
-    def comment(text):
+    def comment(self, text):
+        if self.compact:
+            return ""
         return "\n<!-- %s -->\n" % text
 
-    def set_canvas(self, format_="A4"):
+    def css(self):
+        """CSS rules of the style classes not yet written out"""
+        classes = list(self.classes.items())[self.classes_written:]
+        self.classes_written = len(self.classes)
+        return "".join("    .%s { %s}\n" % (name, declarations)
+                       for declarations, name in classes)
+
+    def late_styles(self):
+        """
+        Style block for the classes first used after doc_header(), to be
+        written before </svg>; CSS applies to the whole document anyway
+        """
+        css = self.css()
+        if css == "":
+            return ""
+        return ' <style type="text/css"><![CDATA[\n%s    ]]></style>\n' % css
+
+    def mm(self, value):
+        """Coordinate as text: mm2, or rounded to precision in compact mode
+        (any real number, also the NumPy scalars of pandas sums)"""
+        if not self.compact or not isinstance(value, numbers.Real):
+            return fmt.mm2(value)
+        s = "%.*f" % (self.precision, float(value))
+        if "." in s:
+            s = s.rstrip("0").rstrip(".")
+        return "0" if s == "-0" else s
+
+    def set_canvas(self, format_="A4", width=None, height=None):
+        """Canvas of a paper format, or "custom" of width x height mm"""
         if format_ == "A4":
             self.canvas = {'format': format_,
                            'mm': {'width': 210, 'height': 297}}
+        elif format_ == "custom":
+            self.canvas = {'format': format_,
+                           'mm': {'width': width, 'height': height}}
         else:
             raise Exception("SVG.set_canvas: Unsupported canvas format %s" %
                             format_)
@@ -197,7 +335,16 @@ class SVG(object):
                 trbl['aspect_ratio'] = float(trbl['height']) / trbl['width']
                 self.canvas[frame][unit] = trbl
 
-    def empty_canvas(self):
+    def empty_canvas(self, exact=False):
+        """
+        Keep texts and icons from overlapping from now on, on a grid of
+        whole mm (Pixels), or with exact=True on their float boxes
+        (BoxIndex)
+        """
+        if exact:
+            self.pixels = BoxIndex()
+            self.icon_pixels = BoxIndex()
+            return
         self.pixels = Pixels(self.canvas['mm']['width'],
                              self.canvas['mm']['height'])
         self.icon_pixels = Pixels(self.canvas['mm']['width'],
@@ -210,25 +357,89 @@ class SVG(object):
     def set_graph_window(self):
         pass
 
-    def style(self, style_dict):
-        if style_dict is None:
-            return ""
+    def declarations(self, style_dict):
         s = ""
         for property_ in list(style_dict):
             value = style_dict.get(property_, None)
             if property_ in ['fill', 'stroke']:  # Translate colours
                 value = lib.app_color(self.colors, value)
+            elif self.compact and type(value) == float:
+                value = self.mm(value)
             if value is not None:
                 s += "%s: %s; " % (property_, value)
+        return s
+
+    def style(self, style_dict):
+        if style_dict is None:
+            return ""
+        s = self.declarations(style_dict)
         return ' style="%s"' % s if s != "" else ""
 
+    def style_class(self, style_dict):
+        """Name of the shared CSS class for style_dict, None if empty"""
+        if style_dict is None:
+            return None
+        declarations = self.declarations(style_dict)
+        if declarations == "":
+            return None
+        name = self.classes.get(declarations)
+        if name is None:
+            name = self.classes[declarations] = "s%s" % len(self.classes)
+        return name
+
+    def attributes(self, style_dict, class_=None):
+        """
+        Style and class attributes; in compact mode one class attribute,
+        and a style attribute for the ELEMENT_PROPERTIES
+        """
+        if not self.compact:
+            return self.style(style_dict) + (
+                "" if class_ is None else ' class="%s"' % class_)
+        own = None
+        if style_dict is not None:
+            own = {property_: value for property_, value in style_dict.items()
+                   if property_ in ELEMENT_PROPERTIES}
+            if own:
+                style_dict = {property_: value
+                              for property_, value in style_dict.items()
+                              if property_ not in ELEMENT_PROPERTIES}
+        classes = [c for c in (class_, self.style_class(style_dict))
+                   if c is not None]
+        s = ' class="%s"' % " ".join(classes) if classes else ""
+        if own:
+            s += ' style="%s"' % ";".join(
+                "%s:%s" % (property_, self.mm(value))
+                for property_, value in own.items())
+        return s
+
     def plot_text_mm(self, x, y, text, style_dict=None, class_=None,
                      angle=0.0, dy=0.0):
-        class_ = "" if class_ is None else ' class="%s"' % class_
-        transform = ("" if angle == 0 else
-                     ' transform="rotate(%s %s %s)"' % (angle, x, y))
+        if self.compact:
+            transform = ("" if angle == 0 else ' transform="rotate(%s %s %s)"'
+                         % (angle, self.mm(x), self.mm(y)))
+        else:
+            transform = ("" if angle == 0 else
+                         ' transform="rotate(%s %s %s)"' % (angle, x, y))
         text = '<tspan dy="%s">%s</tspan>' % (dy, text) if dy != 0 else text
-        s = ' <text x="%s" y="%s"%s%s%s>%s</text>\n'
+        s = ' <text x="%s" y="%s"%s%s>%s</text>\n'
+        x1, y1, x2, y2 = self.text_box(x, y, text, style_dict)
+        #print "set-pixels x1-x2 %s-%s y1-y2 %s-%s" % (x1, x2, y1, y2)
+        if self.pixels is None:
+            is_free = True
+        else:
+            is_free = self.pixels.rectangle_is_empty(x1, y1, x2, y2)
+        if not is_free:
+            #print "text is not free %s" % text
+            return ""
+        if self.pixels is not None:
+            self.pixels.set(x1, y1, x2, y2)
+        return s % (self.mm(x), self.mm(y),
+                    self.attributes(style_dict, class_), transform, text)
+
+    @staticmethod
+    def text_box(x, y, text, style_dict):
+        """Box (x1, y1, x2, y2) in mm taken up by a text, as plot_text_mm()
+        places it"""
         font_size = style_dict.get('font-size', 2)
         text_anchor = style_dict.get('text-anchor', 'left')
         #print "text %s in font size %s adjustment %s" % (text, font_size, text_anchor)
@@ -239,18 +450,30 @@ class SVG(object):
         y1 = y - font_size + 1
         x2 = x + x2_factor * length * font_size / 2
         y2 = y + 1
-        #print "set-pixels x1-x2 %s-%s y1-y2 %s-%s" % (x1, x2, y1, y2)
+        return x1, y1, x2, y2
+
+    def plot_texts_mm(self, texts, priorities=None):
+        """
+        Many texts at once, placed in order of priority (highest first,
+        else in the order given): a text that would overlap one placed
+        before it is left out
+        :param texts: list of (x, y, text, style_dict)
+        :return: the SVG of the placed texts, in the order given
+        """
         if self.pixels is None:
-            is_free = True
+            placed = [True] * len(texts)
         else:
-            is_free = self.pixels.rectangle_is_empty(x1, y1, x2, y2)
-        if not is_free:
-            #print "text is not free %s" % text
-            return ""
-        if self.pixels is not None:
-            self.pixels.set(x1, y1, x2, y2)
-        return s % (fmt.mm2(x), fmt.mm2(y), self.style(style_dict),
-                    class_, transform, text)
+            boxes = [self.text_box(x, y, text, style_dict)
+                     for x, y, text, style_dict in texts]
+            placed = self.pixels.place(boxes, priorities)
+        pixels = self.pixels
+        self.pixels = None  # Already placed: no more checks
+        try:
+            return "".join([self.plot_text_mm(x, y, text, style_dict)
+                            for (x, y, text, style_dict), ok
+                            in zip(texts, placed) if ok])
+        finally:
+            self.pixels = pixels
 
     def plot_icon_mm(self, cx, cy, r=2.5, icon="circle", color="Red"):
         x1, y1, x2, y2 = cx - r, cy - r, cx + r, cy + r
@@ -276,23 +499,26 @@ class SVG(object):
 
     def plot_line_mm(self, x1, y1, x2, y2, style_dict=None):
         line = ' <line x1="%s" y1="%s" x2="%s" y2="%s" %s/>\n'
-        return line % (fmt.mm2(x1), fmt.mm2(y1), fmt.mm2(x2), fmt.mm2(y2),
-                       self.style(style_dict))
+        return line % (self.mm(x1), self.mm(y1), self.mm(x2), self.mm(y2),
+                       self.attributes(style_dict))
 
     def plot_rect_mm(self, x, y, width, height, style_dict=None):
         r = ' <rect x="%s" y="%s" width="%s" height="%s" %s/>\n'
-        return r % (fmt.mm2(x), fmt.mm2(y), fmt.mm2(width), fmt.mm2(height),
-                    self.style(style_dict))
+        return r % (self.mm(x), self.mm(y), self.mm(width), self.mm(height),
+                    self.attributes(style_dict))
 
     def plot_framed_sign_mm(self, x, y, text):
-
-        text = text.decode('utf-8').upper().encode('utf-8')
+        """Blue sign with a white frame and text, its top centre at x, y;
+        left out if its frame would overlap what is already placed"""
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        text = text.upper()
 
         height = 4.8
         margin = 0.4
         font_size = 3.0
         stroke_width = 0.3
-        width = 2.3 * len(text.decode('utf-8'))  # SJL is otherwise 7 char
+        width = 2.3 * len(text)
         inner_width = width - 2 * margin
         inner_height = height - 2 * margin
 
@@ -306,9 +532,17 @@ class SVG(object):
         style_a = {'fill': FI_BLUE, 'stroke-width': 0}
         style_b = {'fill': FI_BLUE, 'stroke-width': stroke_width, 'stroke': 'white'}
         style_c = {'fill': 'white', 'font-size': font_size, 'text-anchor': 'middle'}
-        rt = self.plot_text_mm(xc, yc, text, style_c)
-        if rt == "":
-            return ""
+        pixels = self.pixels
+        if pixels is not None:
+            # The whole frame takes up room, the text inside it with it
+            if not pixels.rectangle_is_empty(xa, ya, xa + width, ya + height):
+                return ""
+            pixels.set(xa, ya, xa + width, ya + height)
+        self.pixels = None
+        try:
+            rt = self.plot_text_mm(xc, yc, text, style_c)
+        finally:
+            self.pixels = pixels
         r = self.plot_rect_mm(xa, ya, width, height, style_a)
         r += self.plot_rect_mm(xb, yb, inner_width, inner_height, style_b)
         r += rt
@@ -497,20 +731,213 @@ class SVG(object):
 
     def draw_pixels(self):
         s = ""
-        for x in range(0, self.pixels.x_max):
-            for y in range(0, self.pixels.y_max):
-                if self.pixels.matrix[y][x]:
-                    s += self.plot_rect_mm(x, y, 1, 1, {'fill': 'red',
-                                                        'opacity': 0.2})
+        if isinstance(self.pixels, BoxIndex):
+            for x1, y1, x2, y2 in self.pixels.boxes:
+                s += self.plot_rect_mm(x1, y1, x2 - x1, y2 - y1,
+                                       {'fill': 'red', 'opacity': 0.2})
+            return s
+        for x, y in np.argwhere(self.pixels.matrix.T).tolist():
+            s += self.plot_rect_mm(x, y, 1, 1, {'fill': 'red',
+                                                'opacity': 0.2})
         return s
 
 
+def write_png(filename, image, compresslevel=6):
+    """
+    Write an RGB image as PNG, with only zlib and struct
+    :param image: NumPy uint8 array of shape (height, width, 3)
+    :return: number of bytes written
+    """
+    height, width = image.shape[:2]
+    # Each scanline starts with filter type 0 (none)
+    scanlines = np.zeros((height, 1 + 3 * width), dtype=np.uint8)
+    scanlines[:, 1:] = image.reshape(height, 3 * width)
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    png = (b"\x89PNG\r\n\x1a\n" +
+           chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0,
+                                      0)) +
+           chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compresslevel)) +
+           chunk(b"IEND", b""))
+    with lib.atomic_write(filename, "wb") as f:
+        f.write(png)
+    return len(png)
+
+
+NAMED_COLORS = {'black': (0, 0, 0), 'white': (255, 255, 255),
+                'red': (255, 0, 0), 'green': (0, 128, 0),
+                'blue': (0, 0, 255), 'yellow': (255, 255, 0),
+                'orange': (255, 165, 0), 'grey': (128, 128, 128),
+                'gray': (128, 128, 128)}
+
+
+def color2rgb(color):
+    """(r, g, b) of a #rrggbb, #rgb or basic named colour, else None"""
+    color = str(color).strip()
+    if color.startswith("#"):
+        digits = color[1:]
+        if len(digits) == 3:
+            digits = "".join(d + d for d in digits)
+        if len(digits) == 6:
+            try:
+                return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+            except ValueError:
+                return None
+        return None
+    return NAMED_COLORS.get(color.lower())
+
+
+class Raster(SVG):
+    """
+    PNG preview backend: a drop-in for SVG whose plot_rect_mm() paints the
+    filled rectangles straight into a NumPy RGB array instead of returning
+    markup; save_as() runs the fragments through and writes a PNG
+
+    Labels, lines and comments are left out. Each rectangle gets a one
+    pixel outline along its top and left edge, which between neighbouring
+    cells makes up the SVG's 0.2 mm black cell borders. plot_cells_mm()
+    paints the cells of a whole diagram at once, without the markup path.
+    """
+
+    def __init__(self, colors, dots_per_mm=4):
+        SVG.__init__(self, colors)
+        self.dots_per_mm = dots_per_mm
+        self.image = None
+        self.rgb = {}
+        self.stroke = np.array((0, 0, 0), dtype=np.uint8)
+
+    def doc_header(self, more_defs=""):
+        height = int(round(self.canvas['mm']['height'] * self.dots_per_mm))
+        width = int(round(self.canvas['mm']['width'] * self.dots_per_mm))
+        self.image = np.full((height, width, 3), 255, dtype=np.uint8)
+        return ""
+
+    def comment(self, text):
+        return ""
+
+    def late_styles(self):
+        return ""
+
+    def fill_rgb(self, color):
+        rgb = self.rgb.get(color)
+        if rgb is None:
+            rgb = color2rgb(lib.app_color(self.colors, color))
+            rgb = self.rgb[color] = (None if rgb is None else
+                                     np.array(rgb, dtype=np.uint8))
+        return rgb
+
+    def plot_rect_mm(self, x, y, width, height, style_dict=None):
+        if self.image is None or style_dict is None:
+            return ""
+        rgb = self.fill_rgb(style_dict.get('fill'))
+        if rgb is None:
+            return ""
+        scale = self.dots_per_mm
+        x0 = int(round(x * scale))
+        y0 = int(round(y * scale))
+        x1 = int(round((x + width) * scale))
+        y1 = int(round((y + height) * scale))
+        self.image[y0:y1, x0:x1] = self.stroke
+        self.image[y0 + 1:y1, x0 + 1:x1] = rgb
+        return ""
+
+    def plot_cells_mm(self, rects, fills, palette):
+        """
+        Fast path of plot_rect_mm() for all cells of one diagram: paints
+        them in one vectorized pass, as a map of which cell covers each
+        pixel (a 2-D prefix sum of +/- cell numbers at the corners), so
+        the rectangles must not overlap
+        :param rects: array of (x0, y0, x1, y1) rows in mm
+        :param fills: index into palette of the fill colour of each rect
+        :param palette: list of colours
+        """
+        if self.image is None or len(rects) == 0:
+            return ""
+        rgbs = [self.fill_rgb(color) for color in palette]
+        known = np.array([rgb is not None for rgb in rgbs])
+        colors = np.array([self.stroke if rgb is None else rgb
+                           for rgb in rgbs], dtype=np.uint8)
+        fills = np.asarray(fills)
+        keep = np.flatnonzero(known[fills])
+        fills = fills[keep]
+        if len(keep) == 0:
+            return ""
+        height, width = self.image.shape[:2]
+        corners = np.rint(np.asarray(rects, dtype=float)[keep] *
+                          self.dots_per_mm)
+        x0, x1 = np.clip(corners[:, 0::2], 0, width).astype(np.intp).T
+        y0, y1 = np.clip(corners[:, 1::2], 0, height).astype(np.intp).T
+        # Only the band of the page that the diagram covers
+        top, bottom = y0.min(), y1.max()
+        y0 = y0 - top
+        y1 = y1 - top
+        height = bottom - top
+        cell = np.zeros((height + 1, width + 1), dtype=np.int32)
+        numbers = np.arange(1, len(keep) + 1, dtype=np.int32)
+        np.add.at(cell, (y0, x0), numbers)
+        np.add.at(cell, (y0, x1), -numbers)
+        np.add.at(cell, (y1, x0), -numbers)
+        np.add.at(cell, (y1, x1), numbers)
+        cell = cell.cumsum(0).cumsum(1)[:height, :width]
+        # The outline: the top row and left column of each rectangle
+        outline = np.ones((height, width), dtype=bool)
+        outline[1:] = cell[1:] != cell[:-1]
+        outline[:, 1:] |= cell[:, 1:] != cell[:, :-1]
+        inside = cell > 0
+        outline &= inside
+        inside &= ~outline
+        band = self.image[top:bottom]
+        band[outline] = self.stroke
+        band[inside] = colors[fills[cell[inside] - 1]]
+        return ""
+
+    def plot_text_mm(self, x, y, text, style_dict=None, class_=None,
+                     angle=0.0, dy=0.0):
+        return ""
+
+    def plot_line_mm(self, x1, y1, x2, y2, style_dict=None):
+        return ""
+
+    def save_as(self, filename, fragments, verbose=False):
+        """
+        Paint the fragments (typically a generator) into the image and
+        write it as PNG
+        :return: number of bytes saved; 0 = no fragments, no file written
+        """
+        painted = False
+        for _ in fragments:
+            painted = True
+        if not painted or self.image is None:
+            return 0
+        with lib.tracer.span("write"):
+            size = write_png(filename, self.image)
+        lib.tracer.count("bytes", size)
+        if verbose:
+            print("%s bytes saved into file %s" % (lib.i1000(size), filename))
+        return size
+
+
 class Pixels(object):
+    """
+    Occupancy grid of the canvas in whole mm, to keep texts and icons from
+    overlapping: a NumPy bool array, matrix[y][x]
+
+    Beside it runs a summed-area table, which set() updates in place for
+    the pixels it newly sets, so that every emptiness query, also between
+    sets, is four lookups. Pixels set straight into matrix are only seen
+    by the queries after a summed_area_table() rebuild.
+    """
+
     def __init__(self, x_max=300, y_max=300):
-        self.x_max = x_max
-        self.y_max = y_max
-        self.matrix = [[False for x in range(0, x_max)]
-                       for y in range(0, y_max)]
+        self.x_max = int(x_max)
+        self.y_max = int(y_max)
+        self.matrix = np.zeros((self.y_max, self.x_max), dtype=bool)
+        # table[y][x]: number of pixels set above and left of (x, y)
+        self.table = np.zeros((self.y_max + 1, self.x_max + 1),
+                              dtype=np.int32)
 
     def clean(self, x1, y1, x2, y2):
         x1 = max(0, int(x1))
@@ -521,16 +948,207 @@ class Pixels(object):
 
     def set(self, x1, y1, x2, y2):
         x1, y1, x2, y2 = self.clean(x1, y1, x2, y2)
-        for x in range(x1, x2):
-            for y in range(y1, y2):
-                self.matrix[y][x] = True
+        if x1 >= x2 or y1 >= y2:
+            return
+        box = self.matrix[y1:y2, x1:x2]
+        new = ~box
+        box[...] = True
+        # The new pixels add their own summed-area table within the box,
+        # and its last column, row and corner right of and below it
+        sums = new.cumsum(0, dtype=np.int32).cumsum(1)
+        t = self.table
+        t[y1 + 1:y2 + 1, x1 + 1:x2 + 1] += sums
+        t[y1 + 1:y2 + 1, x2 + 1:] += sums[:, -1:]
+        t[y2 + 1:, x1 + 1:x2 + 1] += sums[-1:, :]
+        t[y2 + 1:, x2 + 1:] += sums[-1, -1]
+
+    def summed_area_table(self):
+        """The summed-area table, rebuilt from matrix"""
+        self.table[1:, 1:] = self.matrix.cumsum(0).cumsum(1)
+        return self.table
 
     def rectangle_is_empty(self, x1, y1, x2, y2):
         x1, y1, x2, y2 = self.clean(x1, y1, x2, y2)
-        no_text = True
-        for x in range(x1, x2):
-            for y in range(y1, y2):
-                no_text = no_text and not self.matrix[y][x]
-        return no_text
+        if x1 >= x2 or y1 >= y2:
+            return True
+        t = self.table
+        return t[y2, x2] - t[y1, x2] - t[y2, x1] + t[y1, x1] == 0
+
+    def rectangles_are_empty(self, boxes):
+        """
+        rectangle_is_empty() of many candidate boxes at once
+        :param boxes: array of (x1, y1, x2, y2) rows
+        :return: bool array, True where a box is empty
+        """
+        boxes = np.trunc(np.asarray(boxes, dtype=float).reshape(-1, 4))
+        height, width = self.matrix.shape
+        x1 = np.clip(boxes[:, 0], 0, width).astype(np.intp)
+        y1 = np.clip(boxes[:, 1], 0, height).astype(np.intp)
+        x2 = np.maximum(np.clip(boxes[:, 2], 0, width).astype(np.intp), x1)
+        y2 = np.maximum(np.clip(boxes[:, 3], 0, height).astype(np.intp), y1)
+        t = self.table
+        return t[y2, x2] - t[y1, x2] - t[y2, x1] + t[y1, x1] == 0
+
+    def place(self, boxes, priorities=None):
+        """
+        Set the boxes that are empty, in order of priority (highest first,
+        else in the order given), each one seeing those set before it
+        :return: list of bool, True for each box set
+        """
+        placed = [False] * len(boxes)
+        for i in placement_order(len(boxes), priorities):
+            if self.rectangle_is_empty(*boxes[i]):
+                self.set(*boxes[i])
+                placed[i] = True
+        return placed
+
+
+def placement_order(n, priorities=None):
+    """Indexes of n boxes, highest priority first (ties in given order)"""
+    if priorities is None:
+        return range(n)
+    return np.argsort(-np.asarray(priorities, dtype=float),
+                      kind="stable").tolist()
+
+
+class BoxIndex(object):
+    """
+    Spatial index of boxes with float coordinates (mm), to keep texts and
+    icons from overlapping without snapping them to a grid, as Pixels does
+
+    A uniform hash grid: each box is listed under every square of
+    cell_size mm that it touches, so an overlap query only looks at the
+    boxes in the squares of the queried box. Boxes that merely touch do
+    not overlap. Has the set() / rectangle_is_empty() of Pixels.
+
+    The squares of a query are clamped to the extent of the grid, and a
+    query with more squares than there are boxes scans the boxes instead.
+    Boxes that touch more than max_squares squares are kept in a list of
+    their own, which every query scans.
+    """
+
+    max_squares = 256
+
+    def __init__(self, cell_size=4.0):
+        self.cell_size = cell_size
+        self.boxes = []
+        self.grid = {}  # (column, row) -> ids of the boxes in the square
+        self.extent = None  # first and last column and row in grid
+        self.large = []  # ids of the boxes not in grid
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def squares(self, x1, y1, x2, y2):
+        size = self.cell_size
+        columns = range(int(math.floor(x1 / size)),
+                        int(math.floor(x2 / size)) + 1)
+        for row in range(int(math.floor(y1 / size)),
+                         int(math.floor(y2 / size)) + 1):
+            for column in columns:
+                yield column, row
+
+    @staticmethod
+    def normalize(x1, y1, x2, y2):
+        return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+    def insert(self, x1, y1, x2, y2):
+        """Add a box; return its id"""
+        box = self.normalize(x1, y1, x2, y2)
+        id_ = len(self.boxes)
+        self.boxes.append(box)
+        size = self.cell_size
+        columns = (box[2] - box[0]) / size + 2
+        rows = (box[3] - box[1]) / size + 2
+        if not columns * rows <= self.max_squares:  # also for inf and nan
+            self.large.append(id_)
+            return id_
+        for column, row in self.squares(*box):
+            self.grid.setdefault((column, row), []).append(id_)
+        # The last square is the bottom right one
+        first = (int(math.floor(box[0] / size)),
+                 int(math.floor(box[1] / size)))
+        if self.extent is None:
+            self.extent = first + (column, row)
+        else:
+            column1, row1, column2, row2 = self.extent
+            self.extent = (min(column1, first[0]), min(row1, first[1]),
+                           max(column2, column), max(row2, row))
+        return id_
+
+    set = insert
+
+    def candidates(self, x1, y1, x2, y2):
+        """
+        Lists of the ids of the boxes that may overlap the (normalized)
+        box, ids possibly repeated: the large ones, then those of its
+        squares of the grid
+        """
+        if self.large:
+            yield self.large
+        if self.extent is None:
+            return
+        column1, row1, column2, row2 = self.extent
+        size = self.cell_size
+        x1 /= size
+        y1 /= size
+        x2 /= size
+        y2 /= size
+        if x1 > column1:
+            column1 = int(x1 // 1)
+        if y1 > row1:
+            row1 = int(y1 // 1)
+        if x2 < column2:
+            column2 = int(x2 // 1)
+        if y2 < row2:
+            row2 = int(y2 // 1)
+        if column1 > column2 or row1 > row2:
+            return
+        if (column2 - column1 + 1) * (row2 - row1 + 1) > len(self.boxes):
+            yield range(len(self.boxes))
+            return
+        get = self.grid.get
+        columns = range(column1, column2 + 1)
+        for row in range(row1, row2 + 1):
+            for column in columns:
+                yield get((column, row), ())
+
+    def overlapping(self, x1, y1, x2, y2):
+        """Ids of the boxes that overlap the box, in insertion order"""
+        x1, y1, x2, y2 = self.normalize(x1, y1, x2, y2)
+        found = set()
+        boxes = self.boxes
+        for ids in self.candidates(x1, y1, x2, y2):
+            for id_ in ids:
+                if id_ in found:
+                    continue
+                bx1, by1, bx2, by2 = boxes[id_]
+                if bx1 < x2 and x1 < bx2 and by1 < y2 and y1 < by2:
+                    found.add(id_)
+        return sorted(found)
+
+    def rectangle_is_empty(self, x1, y1, x2, y2):
+        """True if no box overlaps the box"""
+        x1, y1, x2, y2 = self.normalize(x1, y1, x2, y2)
+        boxes = self.boxes
+        for ids in self.candidates(x1, y1, x2, y2):
+            for id_ in ids:
+                bx1, by1, bx2, by2 = boxes[id_]
+                if bx1 < x2 and x1 < bx2 and by1 < y2 and y1 < by2:
+                    return False
+        return True
+
+    def place(self, boxes, priorities=None):
+        """
+        Insert the boxes that overlap none before them, in order of
+        priority (highest first, else in the order given)
+        :return: list of bool, True for each box inserted
+        """
+        placed = [False] * len(boxes)
+        for i in placement_order(len(boxes), priorities):
+            if self.rectangle_is_empty(*boxes[i]):
+                self.insert(*boxes[i])
+                placed[i] = True
+        return placed
 
 FI_BLUE = '#0091FF'
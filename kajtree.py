@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+
+"""
+Hierarchical Voronoi (treemap) layout on NumPy arrays
+
+The rows are sorted once by all hierarchy columns, after which every group
+on every level is a contiguous range of rows. HierarchyIndex aggregates
+those groups into nodes once per input sheet, and the layout partitions
+offsets into its arrays instead of copying DataFrames. It gives exactly
+the same rectangles as the recursive split_into_subtrees() in voronoi.py.
+"""
+
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import kajlib as lib
+
+
+def factorize(values):
+    """Integer codes and sorted unique values of one hierarchy column"""
+    values = np.asarray(values)
+    try:
+        uniques, codes = np.unique(values, return_inverse=True)
+    except TypeError:
+        # Mixed numbers and texts: numbers first, as pandas sorts them
+        uniques = sorted(set(values.tolist()),
+                         key=lambda v: (isinstance(v, str), v))
+        lookup = {v: i for i, v in enumerate(uniques)}
+        codes = np.array([lookup[v] for v in values.tolist()], dtype=np.intp)
+        uniques = np.array(uniques, dtype=object)
+    return codes.reshape(-1), uniques
+
+
+def sort_rows(columns):
+    """
+    Sort rows lexicographically by the hierarchy columns
+    :param columns: list of hierarchy columns, top level first
+    :return: row order, codes[level][row] in that order, uniques per level
+    """
+    factorized = [factorize(column) for column in columns]
+    codes = [c for c, u in factorized]
+    uniques = [u for c, u in factorized]
+    order = np.lexsort(codes[::-1])
+    return order, np.vstack([c[order] for c in codes]), uniques
+
+
+class HierarchyIndex(object):
+    """
+    Per-node aggregates of a hierarchy, built once per input sheet
+
+    Node 0 is the root; then come the nodes of level 1, level 2 and so on,
+    each level in sorted row order. All per-node values are NumPy arrays
+    indexed by node id. The children of a node are children[child_start:
+    child_end], sorted by area sum, largest first (ties in sorted order).
+    """
+
+    def __init__(self, columns, area, quality, count=None, weighted=None):
+        """
+        :param columns: list of hierarchy columns, top level first
+        :param area: area of each row
+        :param quality: quality of each row
+        :param count: number of original rows behind each row (default 1);
+            rows may be aggregates, with quality the sum over the original
+            rows and weighted the sum of their quality * area
+        """
+        order, self.codes, self.uniques = sort_rows(columns)
+        self.levels = len(columns)
+        rows = len(order)
+        area = np.asarray(area)[order]
+        quality = np.asarray(quality, dtype=float)[order]
+        count = (np.ones(rows, dtype=np.int64) if count is None else
+                 np.asarray(count, dtype=np.int64)[order])
+        weighted = (quality * area if weighted is None else
+                    np.asarray(weighted, dtype=float)[order])
+
+        # First row of each node, level by level; a new node starts
+        # wherever this or any higher level changes
+        starts = [np.zeros(1 if rows else 0, dtype=np.intp)]
+        changed = np.zeros(rows, dtype=bool)
+        changed[:1] = True
+        for codes in self.codes:
+            changed[1:] |= codes[1:] != codes[:-1]
+            starts.append(np.flatnonzero(changed))
+        sizes = [len(s) for s in starts]
+        self.level_offset = np.concatenate(([0], np.cumsum(sizes)))
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate([np.append(s[1:], rows) for s in starts])
+        self.depth = np.repeat(np.arange(len(starts)), sizes)
+
+        def sums(values):
+            if rows == 0:
+                return values[:0]
+            return np.concatenate([np.add.reduceat(values, s) for s in starts])
+        self.area = sums(area)
+        self.count = sums(count)
+        self.quality_sum = sums(quality)
+        self.weighted_sum = sums(weighted)
+
+        # Parent of each node, and children ordered by area
+        parent = [np.full(sizes[0], -1)]
+        for level in range(1, len(starts)):
+            above = np.searchsorted(starts[level - 1], starts[level],
+                                    side='right') - 1
+            parent.append(above + self.level_offset[level - 1])
+        self.parent = np.concatenate(parent)
+        child_count = np.bincount(self.parent[1:], minlength=len(self.start))
+        self.child_end = np.cumsum(child_count)
+        self.child_start = self.child_end - child_count
+        self.children = np.lexsort((-self.area[1:], self.parent[1:])) + 1
+        self.first_other = len(self.start)
+        self.other_labels = []
+
+    def __len__(self):
+        return len(self.start)
+
+    def fold(self, min_area):
+        """
+        Copy of the index where, under each node, the children smaller than
+        min_area are folded into one "other" node (if there are at least
+        two of them); other nodes have no children, so the layout paints
+        them as leaves, labelled with the number and total area folded
+        """
+        n = len(self)
+        small = self.area[self.children] < min_area
+        parents = self.parent[self.children]
+        folded_count = np.bincount(parents[small], minlength=n)
+        folding = np.flatnonzero(folded_count >= 2)
+        if len(folding) == 0:
+            return self
+        is_folded = small & (folded_count[parents] >= 2)
+        folded = self.children[is_folded]
+        folded_parents = parents[is_folded]
+
+        def sums(values):
+            return np.bincount(folded_parents, weights=values[folded],
+                               minlength=n)[folding]
+        index = HierarchyIndex.__new__(HierarchyIndex)
+        index.__dict__.update(self.__dict__)
+        index.area = np.concatenate((self.area, sums(self.area)))
+        index.count = np.concatenate(
+            (self.count, sums(self.count).astype(self.count.dtype)))
+        index.quality_sum = np.concatenate((self.quality_sum,
+                                            sums(self.quality_sum)))
+        index.weighted_sum = np.concatenate((self.weighted_sum,
+                                             sums(self.weighted_sum)))
+        # An other node starts at the first row of its first folded node,
+        # one level below its parent, and has no children
+        first_folded = np.zeros(n, dtype=np.intp)
+        first_folded[folded_parents[::-1]] = folded[::-1]
+        index.start = np.concatenate((self.start,
+                                      self.start[first_folded[folding]]))
+        index.end = np.concatenate((self.end, self.end[first_folded[folding]]))
+        index.depth = np.concatenate((self.depth, self.depth[folding] + 1))
+        index.parent = np.concatenate((self.parent, folding))
+        index.first_other = n
+        index.other_labels = self.other_labels + [
+            "%s others, %s" % (c, lib.i1000(int(round(a))))
+            for c, a in zip(folded_count[folding].tolist(),
+                            index.area[n:].tolist())]
+
+        # Children: all that are not folded, plus the other nodes
+        nodes = np.concatenate((self.children[~is_folded],
+                                np.arange(n, n + len(folding))))
+        order = np.lexsort((nodes, -index.area[nodes],
+                            index.parent[nodes]))
+        index.children = nodes[order]
+        child_count = np.bincount(index.parent[index.children],
+                                  minlength=len(index.start))
+        index.child_end = np.cumsum(child_count)
+        index.child_start = index.child_end - child_count
+        return index
+
+    def leaves(self):
+        """Number of leaves under the root, i.e. cells at full depth"""
+        frontier = np.zeros(1, dtype=np.intp)
+        leaves = 0
+        while len(frontier):
+            starts = self.child_start[frontier]
+            lengths = self.child_end[frontier] - starts
+            leaves += int(np.count_nonzero(lengths == 0))
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths,
+                                lengths)
+            frontier = self.children[offsets + np.arange(lengths.sum())]
+        return leaves
+
+    def fold_to(self, min_area=0.0, max_cells=None):
+        """
+        fold() with at least min_area, raised until there are at most
+        max_cells leaves (if given)
+        """
+        if len(self) == 0:
+            return self
+        index = self.fold(min_area) if min_area > 0 else self
+        if max_cells:
+            min_area = max(min_area, self.area[0] / max_cells)
+            index = self.fold(min_area)
+            while index.leaves() > max_cells and min_area < self.area[0]:
+                min_area *= 2
+                index = self.fold(min_area)
+        return index
+
+    def quality_mean(self, nodes):
+        """Plain mean of the quality of the rows under each node"""
+        return self.quality_sum[nodes] / self.count[nodes]
+
+    def quality_weighted(self, nodes):
+        """Area-weighted mean of the quality of the rows under each node"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.weighted_sum[nodes] / self.area[nodes]
+
+    def labels(self, nodes, level):
+        """Value of hierarchy column level (1 = top) in the first row of
+        each node"""
+        first_rows = self.start[nodes]
+        labels = self.uniques[level - 1][self.codes[level - 1][first_rows]]
+        if self.other_labels:
+            others = np.flatnonzero(np.asarray(nodes) >= self.first_other)
+            if len(others):
+                labels = labels.astype(object)
+                for i in others.tolist():
+                    labels[i] = self.other_labels[nodes[i] - self.first_other]
+        return labels
+
+
+def layout(index, depth, x0, y0, x1, y1, counters=None):
+    """
+    Voronoi split of a HierarchyIndex into rectangles, down to level depth
+    :param counters: dict, if given, to add the number of 'splits' to
+    :return: list of (node, x0, y0, x1, y1) in paint order
+    """
+    cells = []
+    splits = 0
+    if len(index) > 0:
+        splits = _split(index, depth, cells, 0, [0], [index.area[0]],
+                        x0, y0, x1, y1)
+    if counters is not None:
+        counters['splits'] = counters.get('splits', 0) + splits
+    return cells
+
+
+def refine(index, cells, depth, dy=0.0, counters=None):
+    """
+    Layout down to level depth from the cells of the diagram one level
+    shallower: cells already at the bottom are kept (moved down by dy),
+    and only the nodes on level depth - 1 are split further
+    :return: list of (node, x0, y0, x1, y1) in paint order, as layout()
+    """
+    refined = []
+    splits = 0
+    for node, x0, y0, x1, y1 in cells:
+        y0 += dy
+        y1 += dy
+        if index.depth[node] == depth - 1 and index.count[node] > 1:
+            splits += _split(index, depth, refined, depth - 1, [node],
+                             [index.area[node]], x0, y0, x1, y1)
+        else:
+            refined.append((node, x0, y0, x1, y1))
+    if counters is not None:
+        counters['splits'] = counters.get('splits', 0) + splits
+    return refined
+
+
+def _split(index, depth, cells, level, nodes, sizes, x0, y0, x1, y1):
+    """
+    Split the sibling nodes of one level into two chunks, as equal in size
+    as can be, then each chunk again, and so on down to level depth
+
+    Works off an explicit stack of (level, nodes, sizes, a, b, rectangle)
+    instead of recursion, so hierarchies of any depth work; the stack only
+    ever holds the pending second halves along the current path. Each list
+    of siblings is reordered in place so that both chunks of a split are
+    the contiguous nodes[a:mid] and nodes[mid:b].
+    :return: number of splits made
+    """
+    count = index.count
+    area = index.area
+    children = index.children
+    child_start = index.child_start
+    child_end = index.child_end
+    stack = [(level, nodes, sizes, 0, len(nodes), x0, y0, x1, y1)]
+    splits = 0
+    while stack:
+        level, nodes, sizes, a, b, x0, y0, x1, y1 = stack.pop()
+
+        # Go one level deeper, if only one entry on this level
+        if b - a == 1:
+            node = nodes[a]
+            if count[node] == 1:  # We have reached the bottom
+                cells.append((node, x0, y0, x1, y1))
+                continue
+            if level == depth or child_start[node] == child_end[node]:
+                # Maximum desired level of recursion, or folded "other" node
+                if sizes[a] > 0:
+                    cells.append((node, x0, y0, x1, y1))
+                continue
+            level += 1
+            kids = children[child_start[node]:child_end[node]]
+            nodes = kids.tolist()
+            sizes = area[kids].tolist()
+            a, b = 0, len(nodes)
+
+        # Separate the entries into two chunks, as equal in size as can be
+        chunk_1 = []
+        chunk_2 = []
+        tree_1_size = tree_2_size = 0
+        for i in range(a, b):
+            if tree_1_size <= tree_2_size:
+                tree_1_size += sizes[i]
+                chunk_1.append(i)
+            else:
+                tree_2_size += sizes[i]
+                chunk_2.append(i)
+        if tree_1_size + tree_2_size <= 0:
+            continue
+        partition = chunk_1 + chunk_2
+        nodes[a:b] = [nodes[i] for i in partition]
+        sizes[a:b] = [sizes[i] for i in partition]
+        mid = a + len(chunk_1)
+        splits += 1
+
+        # Then split both of the two chunks, the first one first
+        first_share = tree_1_size / (tree_1_size + tree_2_size)
+        aspect_ratio = (y1 - y0) / (x1 - x0)
+        if aspect_ratio > 1:
+            y_mid = y0 + first_share * (y1 - y0)
+            if tree_2_size > 0:
+                stack.append((level, nodes, sizes, mid, b, x0, y_mid, x1, y1))
+            if tree_1_size > 0:
+                stack.append((level, nodes, sizes, a, mid, x0, y0, x1, y_mid))
+        else:
+            x_mid = x0 + first_share * (x1 - x0)
+            if tree_2_size > 0:
+                stack.append((level, nodes, sizes, mid, b, x_mid, y0, x1, y1))
+            if tree_1_size > 0:
+                stack.append((level, nodes, sizes, a, mid, x0, y0, x_mid, y1))
+    return splits
+
+
+class LayoutCache(object):
+    """
+    Cache of the cells of all diagrams of a document, in memory and on disk
+
+    The layout only depends on the structure and areas of the hierarchy
+    and on the rectangles it is split into, so a key made of those lets
+    runs that only change colours, rules or quality skip the layout. The
+    last max_entries layouts stay in memory; on disk each is an .npz file
+    of node ids and rectangles, whose time stamp is refreshed on reading.
+    prune() evicts files older than max_age_days and then the least
+    recently used ones until the cache is below max_bytes.
+
+    Errors of the disk cache never fail a layout: a file that cannot be
+    read is a miss, one that cannot be written is only kept in memory,
+    and without a usable folder (dir None) the cache is memory only.
+    Worker processes may share the folder.
+    """
+
+    VERSION = 1  # Of the layout algorithm and file format, part of the key
+
+    def __init__(self, dir_=None, max_entries=8, max_age_days=30,
+                 max_bytes=1 << 30):
+        if dir_ is None:
+            dir_ = os.environ.get("KAJ_LAYOUT_CACHE", os.path.join(
+                os.path.expanduser("~"), ".cache", "kajlayouts"))
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.memory = collections.OrderedDict()
+        try:
+            os.makedirs(dir_, exist_ok=True)
+        except OSError:
+            dir_ = None
+        self.dir = dir_
+
+    @classmethod
+    def key(cls, index, *geometry):
+        """
+        Hash of the hierarchy of index and the geometry (layout method,
+        depths, rectangles, ...) the layout was made with
+        """
+        h = hashlib.sha1(json.dumps([cls.VERSION, len(index), index.levels,
+                                     geometry]).encode("utf8"))
+        for values in (index.parent, index.count, index.area):
+            h.update(np.ascontiguousarray(values, dtype=float).tobytes())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dir, key + ".npz")
+
+    def load(self, key):
+        """The cells of each diagram, or None if not cached"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                sizes = f['sizes']
+                nodes = f['nodes'].tolist()
+                rects = f['rects'].tolist()
+                ints = f['ints']
+            os.utime(path)
+        except Exception:  # Missing, pruned meanwhile, or unreadable
+            return None
+        # Coordinates that were int (the canvas edges) are again, as they
+        # are formatted without decimals
+        for i, j in zip(*np.nonzero(ints)):
+            rects[i][j] = int(rects[i][j])
+        cells = [(node,) + tuple(rect) for node, rect in zip(nodes, rects)]
+        ends = np.cumsum(sizes).tolist()
+        diagrams = [cells[end - size:end]
+                    for size, end in zip(sizes.tolist(), ends)]
+        self._remember(key, diagrams)
+        return diagrams
+
+    def save(self, key, diagrams):
+        """Keep the cells of each diagram, (node, x0, y0, x1, y1) lists"""
+        self._remember(key, diagrams)
+        if self.dir is None:
+            return
+        cells = [cell for cells in diagrams for cell in cells]
+        try:
+            with lib.atomic_write(self._path(key), "wb") as f:
+                np.savez(f, sizes=np.array([len(c) for c in diagrams],
+                                           dtype=np.int64),
+                         nodes=np.array([c[0] for c in cells],
+                                        dtype=np.int64),
+                         rects=np.array([c[1:] for c in cells],
+                                        dtype=float).reshape(-1, 4),
+                         ints=np.array([[type(v) is int for v in c[1:]]
+                                        for c in cells],
+                                       dtype=bool).reshape(-1, 4))
+        except OSError:
+            return
+        self.prune()
+
+    def _remember(self, key, diagrams):
+        self.memory[key] = diagrams
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def prune(self):
+        """Evict files by age, then by total size; return files removed"""
+        if self.dir is None:
+            return 0
+        try:
+            return lib.prune_cache(self.dir, (".npz",), self.max_age_days,
+                                   self.max_bytes)
+        except OSError:
+            return 0
@@ -5,15 +5,120 @@
 Create hierarchical .svg Voronoi tree graphs like GrandPerspective on Mac
 """
 
-import pandas as pd
 import numpy as np
 import kajsvg
+import kajtree
 import kajlib as lib
+import argparse
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import csv
+import glob
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import traceback
 import sys
 import os
 
-def tree_paint(input_spreadsheet, input_sheet, levels, area, quality, borders):
-    # Prepare SVG canvas
+def tree_paint(svg, workbook, input_sheet, levels, area, quality, rules,
+               layout="refine", min_cell_area=None, max_cells=None,
+               layout_file=None, cache=None, csv_reader="csv"):
+    """
+    Generate the SVG document for one macro row, fragment by fragment
+    (nothing at all, if the row has to be skipped)
+    :param layout_file: .npy or .npz file to save the layout_table() of
+        all diagrams into, at the end (layout "array" or "refine")
+    :param cache: kajtree.LayoutCache of the layouts made before
+    :param csv_reader: reader of .csv inputs, see hierarchy_index()
+    """
+    if not has_columns(workbook, input_sheet, levels, area, quality):
+        print("- skipping this row")
+        return
+
+    index = df = None
+    csv_file = input_csv(workbook, input_sheet)
+    if layout in ["array", "refine"]:
+        index = hierarchy_index(workbook, input_sheet, levels, area, quality,
+                                csv_reader)
+    elif csv_file is not None:
+        import pandas as pd
+        df = pd.read_csv(csv_file, usecols=levels + [area, quality])
+        df = df.replace(np.nan, '', regex=True)
+    else:
+        df = workbook.memo(('input', input_sheet), read_input, workbook,
+                           input_sheet)
+    title = f"Voronoi Diagram for {input_sheet}"
+    if index is not None:
+        index = fold_index(svg, title, index, levels, min_cell_area,
+                           max_cells)
+    diagrams = []
+    yield from paint_document(svg, title, levels, area, quality, rules,
+                              layout, index, df, diagrams, cache=cache)
+    if layout_file and index is not None:
+        with lib.tracer.span("layout table", output=layout_file):
+            table = layout_table(index, diagrams, rules)
+            save_layout(layout_file, table)
+        print(f"{lib.i1000(len(table))} cells saved into file {layout_file}")
+
+def has_columns(workbook, input_sheet, levels, area, quality):
+    """Check that all applicable fields exist in the input sheet, telling
+    which are missing"""
+    input_spreadsheet = workbook.filename
+    csv_file = input_csv(workbook, input_sheet)
+    if csv_file is not None:
+        columns = csv_columns(csv_file)
+    else:
+        df = workbook.memo(('input', input_sheet), read_input, workbook,
+                           input_sheet)
+        columns = df.columns
+    ok = True
+    if not area in columns:
+        print(f"voronoi.py: missing area column '{area}' in {input_spreadsheet} "
+              f"tab {input_sheet}")
+        ok = False
+    if not quality in columns:
+        print(f"voronoi.py: missing quality column '{quality}'"
+              f" in {input_spreadsheet} tab {input_sheet}")
+        ok = False
+    for field in levels:
+        if not field in columns:
+            print(f"voronoi.py: missing levels column '{field}' "
+                  f"in {input_spreadsheet} tab {input_sheet}")
+            ok = False
+    return ok
+
+def hierarchy_index(workbook, input_sheet, levels, area, quality,
+                    csv_reader="csv"):
+    """
+    HierarchyIndex of an input sheet or .csv file: the hierarchy is
+    aggregated once; all diagrams (and all rows with the same input sheet
+    and columns) then read from it
+    :param csv_reader: "csv" to read .csv inputs with the csv module
+        (read_csv_index_stdlib(), no pandas import), "pandas" with
+        chunked pandas.read_csv (read_csv_index(), faster on large files)
+    """
+    key = ('index', input_sheet, tuple(levels), area, quality)
+    with lib.tracer.span("aggregate", sheet=input_sheet):
+        csv_file = input_csv(workbook, input_sheet)
+        if csv_file is not None:
+            read = {'csv': read_csv_index_stdlib,
+                    'pandas': read_csv_index}[csv_reader]
+            return workbook.memo(key + (csv_reader,), read, csv_file, levels,
+                                 area, quality)
+        df = workbook.memo(('input', input_sheet), read_input, workbook,
+                           input_sheet)
+        return workbook.memo(key, build_index, df, levels, area, quality)
+
+def set_up_canvas(svg, title):
+    """
+    Prepare the SVG canvas: A4 portrait with its margins
+    :return: x0, y0, x1 of the first diagram, and margin between diagrams
+    """
     svg.set_canvas("A4")
     svg.set_orientation("portrait")
     svg.reset_margins()
@@ -22,72 +127,446 @@ def tree_paint(input_spreadsheet, input_sheet, levels, area, quality, borders):
     #svg.def_margins('inner', 'mm', 30, 19, 21, 14)
     svg.def_margins('inner', 'mm', 10, 10, 10, 10)
     svg.set_margins()
-    svg.set_title(f"Voronoi Diagram for {input_sheet}", "voronoi.py")
-    s = svg.doc_header()
-    s += svg.comment(f"Parameters: Levels {levels} Area {area} Quality {quality}"
-                     f" Borders {borders}")
-    s += svg.comment(f"Margins: {svg.margins}")
-    s += svg.comment(f"Canvas: {svg.canvas}")
-
-    # Positioning of successively deeper charts
-    max_levels = 4
-    available_height = svg.canvas['inner']['mm']['height']
+    svg.set_title(title, "voronoi.py")
     margin = 5
-    block_height = (available_height - (max_levels - 1) * margin) / max_levels
+    return margin, margin, 205, margin
+
+def block_height(svg, levels, margin):
+    """
+    Height of each diagram, and the gap between them: successively deeper
+    charts, at least 4 on the page. The gaps narrow below margin as the
+    levels increase, so that they never take more than a quarter of the
+    page and the diagrams keep a positive height at any depth
+    :return: height, gap
+    """
+    max_levels = max(4, len(levels))
+    available_height = svg.canvas['inner']['mm']['height']
+    gap = min(margin, available_height / 4 / (max_levels - 1))
+    return (available_height - (max_levels - 1) * gap) / max_levels, gap
+
+def fold_index(svg, title, index, levels, min_cell_area=None,
+               max_cells=None):
+    """
+    Level of detail: the index with the siblings too small to see on the
+    page folded into "other" nodes before the layout
+    :param min_cell_area: fold siblings smaller than this many mm2
+    :param max_cells: fold small siblings until the deepest diagram has at
+        most about this many cells
+    """
+    if not (min_cell_area or max_cells) or len(index) == 0:
+        return index
+    x0, y0, x1, margin = set_up_canvas(svg, title)
+    height, gap = block_height(svg, levels, margin)
+    diagram_area = (x1 - x0) * height
+    min_area = index.area[0] * (min_cell_area or 0) / diagram_area
+    with lib.tracer.span("fold"):
+        return index.fold_to(min_area, max_cells)
+
+def paint_document(svg, title, levels, area, quality, rules, layout="refine",
+                   index=None, df=None, diagrams=None, verbose=True,
+                   cache=None):
+    """
+    Generate the SVG document of one diagram per level, fragment by
+    fragment
+    :param index: HierarchyIndex of the data (layout "array" or "refine")
+    :param df: DataFrame of the data (layout "reference")
+    :param diagrams: list, if given, to append the cells of each diagram to
+    :param verbose: show the progress per level on stdout
+    :param cache: kajtree.LayoutCache, if given, to take the cells from
+        when the hierarchy and canvas are as before, or to keep them in
+    """
+    progress = sys.stdout.write if verbose else (lambda text: None)
+    x0, y0, x1, margin = set_up_canvas(svg, title)
+
+    # Positioning of successively deeper charts, at least 4 on the page
+    height, margin = block_height(svg, levels, margin)
     #scale = 1 - 81. / 175
     #scale = 1
-    #block_height = 68 * scale
-
-    x0 = margin
-    x1 = 205
-    y0 = margin
-    y1 = y0 + block_height
+    #height = 68 * scale
+    y1 = y0 + height
 
-    df = pd.read_excel(input_spreadsheet, sheet_name=input_sheet)
-    df = df.replace(np.nan, '', regex=True)
+    # Only colours, rules or quality changed: no new layout needed
+    key = cached = None
+    if cache is not None and index is not None:
+        key = cache.key(index, layout, len(levels), svg.canvas['mm'],
+                        x0, y0, x1, y1, margin + height)
+        with lib.tracer.span("layout cache"):
+            cached = cache.load(key)
+    if diagrams is None:
+        diagrams = []
 
-    # Check that all applicable fields exist
-    skip = False
-    if not area in df.columns:
-        print(f"voronoi.py: missing area column '{area}' in {input_spreadsheet} "
-              f"tab {input_sheet}")
-        skip = True
-    if not quality in df.columns:
-        print(f"voronoi.py: missing quality column '{quality}'"
-              f" in {input_spreadsheet} tab {input_sheet}")
-        skip = True
-    for field in levels:
-        if not field in df.columns:
-            print(f"voronoi.py: missing levels column '{field}' "
-                  f"in {input_spreadsheet} tab {input_sheet}")
-            skip = True
-    if skip:
-        print("- skipping this row")
-        return ""
+    if svg.compact:
+        # Cell fills are known up front: their classes go into the header
+        for bg_color in rules.bg_colors:
+            svg.style_class({'fill': bg_color})
+    yield svg.doc_header()
+    yield svg.comment(f"Parameters: Levels {levels} Area {area} "
+                      f"Quality {quality} Borders {rules.borders}")
+    yield svg.comment(f"Margins: {svg.margins}")
+    yield svg.comment(f"Canvas: {svg.canvas}")
 
-    # Create the (max 4) hierarchical levels of Voronoi diagrams
+    # Create one Voronoi diagram per hierarchical level
     current_level = []
     for item in levels:
         current_level.append(item)
         cols = levels + [area, quality]
         level_slash = "/".join(current_level)
-        s += svg.comment(f"Level {level_slash}, cols {cols}")
-        sys.stdout.write(f"\n{level_slash}: ")
-        data2 = df[cols]
-        data = data2.set_index(levels)
-        s += split_into_subtrees(data, current_level, 1, x0, y0, x1, y1,
-                                 item, area, quality, borders)
-        y0 += margin + block_height
-        y1 += margin + block_height
-    s += "</svg>"
-    return s
+        yield svg.comment(f"Level {level_slash}, cols {cols}")
+        progress(f"\n{level_slash}: ")
+        if layout in ["array", "refine"]:
+            depth = len(current_level)
+            if cached is not None:
+                cells = cached[depth - 1]
+            else:
+                counters = {}
+                with lib.tracer.span("layout", level=level_slash):
+                    if layout == "refine" and depth > 1:
+                        # Keep the partition of the diagram above, split
+                        # deeper
+                        cells = kajtree.refine(index, cells, depth,
+                                               margin + height, counters)
+                    else:
+                        cells = kajtree.layout(index, depth, x0, y0, x1,
+                                               y1, counters)
+                lib.tracer.count("splits", counters['splits'])
+            lib.tracer.count("cells", len(cells))
+            diagrams.append(cells)
+            progress(f"{len(cells)} cells" +
+                     (" (cached layout)" if cached is not None else ""))
+            # Painted in batches, so that the paint spans leave out the
+            # writing of the fragments
+            fragments = paint_cells(svg, index, cells, depth, rules)
+            while True:
+                with lib.tracer.span("paint", level=level_slash):
+                    batch = list(itertools.islice(fragments, 4096))
+                if not batch:
+                    break
+                yield "".join(batch)
+        else:
+            data2 = df[cols]
+            data = data2.set_index(levels)
+            with lib.tracer.span("layout and paint", level=level_slash):
+                s = split_into_subtrees(svg, data, current_level, 1, x0, y0,
+                                        x1, y1, item, area, quality, rules)
+            yield s
+        y0 += margin + height
+        y1 += margin + height
+    if key is not None and cached is None:
+        with lib.tracer.span("layout cache"):
+            cache.save(key, diagrams)
+    yield svg.late_styles()
+    yield "</svg>"
+    progress("\n")
+
+def paint_cells(svg, index, cells, depth, rules):
+    """
+    Generate the SVG fragments of the cells of one diagram
+    :param cells: list of (node, x0, y0, x1, y1), from kajtree
+    """
+    if isinstance(svg, kajsvg.Raster):
+        # PNG preview: only the fill colours, painted all at once
+        table = np.array(cells, dtype=float).reshape(-1, 5)
+        nodes = table[:, 0].astype(np.intp)
+        yield svg.plot_cells_mm(table[:, 1:],
+                                rules.choose(index.quality_mean(nodes)),
+                                rules.bg_colors)
+        return
+    nodes = [cell[0] for cell in cells]
+    bg_colors, fg_colors = rules.colors(index.quality_mean(nodes))
+    labels = [str(text) for text in index.labels(nodes, depth)]
+    rects = np.array([cell[1:] for cell in cells], dtype=float)
+    text_lengths = np.array([len(text) for text in labels])
+    text_labels = zip(*label_layout(rects.reshape(-1, 4), text_lengths))
+    for (node, x0, y0, x1, y1), text, bg_color, fg_color, label in zip(
+            cells, labels, bg_colors, fg_colors, text_labels):
+        yield paint_leaf(svg, x0, y0, x1, y1, text, bg_color, fg_color, label)
+
+def layout_table(index, diagrams, rules):
+    """
+    The cells of all diagrams as one typed table, for consumers other than
+    SVG: a NumPy structured array with a row per cell and the columns
+    diagram (1 = top level), node, depth, x0, y0, x1, y1 (mm), area,
+    quality (mean), color (index of the matching rule in rules.bg_colors)
+    and label
+    :param diagrams: list of the (node, x0, y0, x1, y1) cells of each
+        diagram, as paint_document() and render() return them
+    """
+    sizes = [len(cells) for cells in diagrams]
+    nodes = np.array([cell[0] for cells in diagrams for cell in cells],
+                     dtype=np.int64).reshape(-1)
+    rects = np.array([cell[1:] for cells in diagrams for cell in cells],
+                     dtype=float).reshape(-1, 4)
+    labels = [np.asarray(index.labels(cells_nodes, level), dtype=str)
+              for level, cells_nodes in enumerate(
+                  np.split(nodes, np.cumsum(sizes)[:-1]), 1)]
+    labels = np.concatenate(labels) if labels else np.array([], dtype=str)
+    quality = index.quality_mean(nodes)
+    table = np.zeros(len(nodes), dtype=[
+        ('diagram', np.int16), ('node', np.int32 if len(index) < 2 ** 31
+                                else np.int64),
+        ('depth', np.int16), ('x0', float), ('y0', float), ('x1', float),
+        ('y1', float), ('area', float), ('quality', float),
+        ('color', np.int8), ('label', labels.dtype)])
+    table['diagram'] = np.repeat(np.arange(1, len(sizes) + 1), sizes)
+    table['node'] = nodes
+    table['depth'] = index.depth[nodes]
+    for i, field in enumerate(['x0', 'y0', 'x1', 'y1']):
+        table[field] = rects[:, i]
+    table['area'] = index.area[nodes]
+    table['quality'] = quality
+    table['color'] = rules.choose(quality)
+    table['label'] = labels
+    return table
+
+def save_layout(filename, table):
+    """
+    Save a layout_table(): .npz as one array per column, anything else as
+    a .npy structured array, which np.load(filename, mmap_mode='r') maps
+    into memory without reading it
+    """
+    with lib.atomic_write(filename, "wb") as f:
+        if filename.endswith(".npz"):
+            np.savez(f, **{field: table[field]
+                           for field in table.dtype.names})
+        else:
+            np.save(f, table)
+
+TILES_INDEX = "tiles.json"
+
+def export_tiles(index, folder, rules, colors=None, tile_format="svg",
+                 tile_mm=64.0, aspect=1.0, detail=1, precision=None,
+                 title="Voronoi Diagram"):
+    """
+    Write the diagram as a pyramid of tiles, for a viewer that only loads
+    what is on screen: zoom level z has one tile per node of level z with
+    children, showing its subtree detail levels deep, and the TILES_INDEX
+    of the folder lists the bounds of every tile in world coordinates
+    (those of the zoom level 0 tile, the root)
+
+    Each tile is laid out on its own, on a canvas tile_mm long on its
+    longer side; as a split only depends on the proportions of the
+    rectangle, a tile is the zoomed-in part of the diagram above it.
+    :param folder: output folder; tile z/node.svg is node on level z
+    :param tile_format: "svg", "svgz" or "png"
+    :param aspect: height / width of the whole diagram
+    :param precision: decimals of compact SVG tiles (None = plain SVG)
+    :return: number of tiles written
+    """
+    if not isinstance(rules, ColorRules):
+        rules = ColorRules(rules)
+    width = float(tile_mm)
+    height = tile_mm * aspect
+    tiles = []
+    cells = []
+    if len(index) > 0 and index.area[0] > 0:
+        cells = [(0, 0.0, 0.0, width, height)]
+    has_children = index.child_end > index.child_start
+    for z in range(index.levels):
+        if z > 0:
+            with lib.tracer.span("layout", level=z):
+                cells = kajtree.refine(index, cells, z)
+        nodes = [cell for cell in cells if index.depth[cell[0]] == z and
+                 index.count[cell[0]] > 1 and has_children[cell[0]]]
+        if not nodes:
+            break
+        os.makedirs(os.path.join(folder, str(z)), exist_ok=True)
+        labels = ([title] if z == 0 else
+                  index.labels([cell[0] for cell in nodes], z).tolist())
+        for (node, x0, y0, x1, y1), label in zip(nodes, labels):
+            tile = os.path.join(str(z), f"{node}.{tile_format}")
+            scale = tile_mm / max(x1 - x0, y1 - y0)
+            size = [round(scale * (x1 - x0), 3), round(scale * (y1 - y0), 3)]
+            with lib.tracer.span("tile", level=z):
+                paint_tile(index, node, size, min(z + detail, index.levels),
+                           rules, colors, os.path.join(folder, tile),
+                           str(label), precision)
+            tiles.append({'z': z, 'node': node, 'file': tile,
+                          'label': str(label), 'bounds': [x0, y0, x1, y1],
+                          'size': size})
+    lib.tracer.count("tiles", len(tiles))
+    remove_stale_tiles(folder, [tile['file'] for tile in tiles])
+    tiles_index = {'title': title, 'format': tile_format,
+                   'width': width, 'height': height, 'tile_mm': tile_mm,
+                   'levels': index.levels, 'detail': detail, 'tiles': tiles}
+    with lib.atomic_write(os.path.join(folder, TILES_INDEX)) as f:
+        json.dump(tiles_index, f)
+    return len(tiles)
+
+def remove_stale_tiles(folder, files):
+    """Remove the tiles of earlier runs that are not among files, in the
+    zoom level folders 0, 1, ... of folder"""
+    keep = set(os.path.normpath(file) for file in files)
+    for name in os.listdir(folder):
+        level_folder = os.path.join(folder, name)
+        if not name.isdigit() or not os.path.isdir(level_folder):
+            continue
+        for tile in os.listdir(level_folder):
+            if os.path.join(name, tile) not in keep:
+                os.remove(os.path.join(level_folder, tile))
+        if not os.listdir(level_folder):
+            os.rmdir(level_folder)
+
+def paint_tile(index, node, size, depth, rules, colors, filename, title,
+               precision=None):
+    """
+    Write one tile: the subtree of node down to level depth, laid out on a
+    custom canvas of size (width, height) mm
+    """
+    svg = new_canvas(colors or {}, filename, precision)
+    svg.set_canvas("custom", *size)
+    svg.set_title(title, "voronoi.py")
+    cells = [(node, 0.0, 0.0) + tuple(size)]
+    for level in range(index.depth[node] + 1, depth + 1):
+        cells = kajtree.refine(index, cells, level)
+
+    def fragments():
+        if svg.compact:
+            for bg_color in rules.bg_colors:
+                svg.style_class({'fill': bg_color})
+        yield svg.doc_header()
+        yield from paint_cells(svg, index, cells, depth, rules)
+        yield svg.late_styles()
+        yield "</svg>"
+    return svg.save_as(filename, fragments())
+
+def read_input(workbook, input_sheet):
+    df = workbook.sheet(input_sheet)
+    return df.replace(np.nan, '', regex=True)
 
-def split_into_subtrees(data, levels, level, x0, y0, x1, y1,
-                        text_field, area, quality, borders):
+def build_index(df, levels, area, quality):
+    return kajtree.HierarchyIndex([df[c].values for c in levels],
+                                  df[area].values, df[quality].values)
+
+def is_csv(input_sheet):
+    """Input sheet given as a (possibly gzipped) .csv file name?"""
+    return input_sheet.lower().endswith((".csv", ".csv.gz"))
+
+def csv_path(workbook, input_sheet):
+    """.csv input files are relative to the folder of the workbook"""
+    return os.path.join(os.path.dirname(workbook.filename), input_sheet)
+
+def input_csv(workbook, input_sheet):
+    """The .csv file of an input sheet, or None if it is a spreadsheet tab
+    (every sheet of a CsvWorkbook is a .csv file)"""
+    if is_csv(input_sheet):
+        return csv_path(workbook, input_sheet)
+    if isinstance(workbook, lib.CsvWorkbook):
+        return workbook.paths.get(input_sheet)
+    return None
+
+def open_csv(csv_file):
+    """Open a (possibly gzipped) .csv file as text for the csv module"""
+    if csv_file.lower().endswith(".gz"):
+        return gzip.open(csv_file, "rt", newline="", encoding="utf-8-sig")
+    return open(csv_file, newline="", encoding="utf-8-sig")
+
+def csv_columns(csv_file):
+    with open_csv(csv_file) as f:
+        return next(csv.reader(f), [])
+
+def records(sheet):
+    """(index, row) pairs of a sheet, with empty cells as '': a DataFrame,
+    or the list of row dicts of a CsvWorkbook"""
+    if isinstance(sheet, list):
+        return enumerate(sheet)
+    return sheet.replace(np.nan, '', regex=True).iterrows()
+
+def read_csv_index_stdlib(csv_file, levels, area, quality):
+    """
+    read_csv_index() with the csv module instead of pandas: the rows are
+    aggregated by all levels in a dict as they stream in, so memory is
+    again bound by the number of distinct level combinations
+    """
+    totals = {}
+    rows = 0
+    with open_csv(csv_file) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        level_fields = [header.index(field) for field in levels]
+        area_field = header.index(area)
+        quality_field = header.index(quality)
+        width = len(header)
+        for row in reader:
+            if not row:  # Blank line
+                continue
+            if len(row) < width:  # Missing trailing fields are empty
+                row += [""] * (width - len(row))
+            rows += 1
+            key = tuple([row[i] for i in level_fields])
+            area_val = row[area_field]
+            area_val = float(area_val) if area_val != "" else 0.0
+            quality_val = row[quality_field]
+            quality_val = float(quality_val) if quality_val != "" else 0.0
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [area_val, quality_val, 1,
+                               quality_val * area_val]
+            else:
+                total[0] += area_val
+                total[1] += quality_val
+                total[2] += 1
+                total[3] += quality_val * area_val
+    sys.stdout.write(f"{csv_file}: {rows} rows, {len(totals)} combinations")
+    keys = list(totals)
+    sums = np.array(list(totals.values()), dtype=float).reshape(-1, 4)
+    return kajtree.HierarchyIndex(
+        [np.array([key[i] for key in keys], dtype=object)
+         for i in range(len(levels))],
+        sums[:, 0], sums[:, 1], count=sums[:, 2].astype(np.int64),
+        weighted=sums[:, 3])
+
+def read_csv_index(csv_file, levels, area, quality, chunksize=200000):
+    """
+    Stream a (possibly gzipped) .csv file chunk by chunk into a
+    HierarchyIndex: only the levels, area and quality columns are read,
+    and each chunk is at once aggregated by all levels, so memory is
+    bound by the number of distinct level combinations, not by rows
+    """
+    import pandas as pd
+    sums = {'area': (area, 'sum'), 'quality': (quality, 'sum'),
+            'count': (quality, 'size'), 'weighted': ('weighted', 'sum')}
+    partial = []
+    partial_rows = 0
+    chunks = pd.read_csv(csv_file, usecols=levels + [area, quality],
+                         dtype={field: str for field in levels},
+                         chunksize=chunksize)
+    for chunk in chunks:
+        chunk[levels] = chunk[levels].fillna('')
+        chunk['weighted'] = chunk[quality] * chunk[area]
+        partial.append(chunk.groupby(levels, sort=False).agg(**sums))
+        partial_rows += len(partial[-1])
+        if partial_rows > 4 * chunksize:  # Merge the partial aggregates
+            partial = [pd.concat(partial).groupby(levels, sort=False).sum()]
+            partial_rows = len(partial[0])
+    if not partial:
+        return kajtree.HierarchyIndex([[] for field in levels], [], [])
+    totals = pd.concat(partial).groupby(levels, sort=False).sum()
+    totals = totals.reset_index()
+    sys.stdout.write(f"{csv_file}: {totals['count'].sum()} rows, "
+                     f"{len(totals)} combinations")
+    return kajtree.HierarchyIndex([totals[c].values for c in levels],
+                                  totals['area'].values,
+                                  totals['quality'].values,
+                                  count=totals['count'].values,
+                                  weighted=totals['weighted'].values)
+
+def read_colors(workbook, color_sheet):
+    colors = workbook.sheet(color_sheet)
+    _colors ={}
+    for i, r in records(colors):
+        c1 = r['color']
+        c2 = r['pf_color']
+        hex = r['hex']
+        _colors[c1] = hex
+        _colors[c2] = hex
+    return _colors
+
+def split_into_subtrees(svg, data, levels, level, x0, y0, x1, y1,
+                        text_field, area, quality, rules):
     #print(f"split_into_subtrees(data, {levels} level {level}, x0 {x0:5.2f}, "
     #      f"y0 {y0:5.2f}, x0 {x1:5.2f}, y1 {y1:5.2f}, {text_field})")
-    sys.stdout.write(str(level))
-    sys.stdout.flush()
+    import pandas as pd
+    lib.tracer.count("splits")
     rows = len(data.index)
     #print(f"rows {rows}")
     if rows == 0: # We have "split" a chunk of only one row into two chunks,
@@ -95,9 +574,11 @@ def split_into_subtrees(data, levels, level, x0, y0, x1, y1,
         return ""
     #print(f"Level {level} len(levels) {len(levels)} rows {rows}")
     if rows == 1: # Now we have reached the bottom and can paint
-        return paint_cell(data, x0, y0, x1, y1, text_field, area, quality, borders)
+        return paint_cell(svg, data, x0, y0, x1, y1, text_field, area,
+                          quality, rules)
     if level == len(levels) + 1: # Maximum desired level of recursion
-        return paint_cell(data, x0, y0, x1, y1, text_field, area, quality, borders)
+        return paint_cell(svg, data, x0, y0, x1, y1, text_field, area,
+                          quality, rules)
 
     # The splitting algorithm may have de-sorted the data
     #data_index = data.set_index(levels)
@@ -147,85 +628,136 @@ def split_into_subtrees(data, levels, level, x0, y0, x1, y1,
     if IsPortrait:
         y_mid = y0 + first_share * (y1 - y0)
         if tree_1_size > 0:
-            s = split_into_subtrees(data_1, levels, level, x0, y0, x1, y_mid,
-                                    text_field, area, quality, borders)
+            s = split_into_subtrees(svg, data_1, levels, level, x0, y0, x1,
+                                    y_mid, text_field, area, quality, rules)
         if tree_2_size > 0:
-            s += split_into_subtrees(data_2, levels, level, x0, y_mid, x1, y1,
-                                     text_field, area, quality, borders)
+            s += split_into_subtrees(svg, data_2, levels, level, x0, y_mid,
+                                     x1, y1, text_field, area, quality, rules)
     else:
         x_mid = x0 + first_share * (x1 - x0)
         if tree_1_size > 0:
-            s = split_into_subtrees(data_1, levels, level, x0, y0, x_mid, y1,
-                                    text_field, area, quality, borders)
+            s = split_into_subtrees(svg, data_1, levels, level, x0, y0,
+                                    x_mid, y1, text_field, area, quality,
+                                    rules)
         if tree_2_size > 0:
-            s += split_into_subtrees(data_2, levels, level, x_mid, y0, x1, y1,
-                                     text_field, area, quality, borders)
+            s += split_into_subtrees(svg, data_2, levels, level, x_mid, y0,
+                                     x1, y1, text_field, area, quality, rules)
     return s
 
-def paint_cell(data, x0, y0, x1, y1, text_field, area, quality, borders):
-
-    # Find out colour of cell
+def paint_cell(svg, data, x0, y0, x1, y1, text_field, area, quality, rules):
     row = data.reset_index()
     quality_val = float(row[quality].mean())
-    fg_color = "black"
-    bg_color = borders[-1]["bg_color"]
-    for limit_dict in borders:
-        rule = limit_dict['rule']
-        # last line is an "else" catch-up clause, if the value is empty
-        if rule == "":
-            break
-        pot_bg_color = limit_dict["bg_color"]
-        pot_fg_color = limit_dict["fg_color"]
-        condition = rule[0]
-        value = float(rule[1:])
-        match = False
-        if condition == ">":
-            if quality_val > value:
-                match = True
-        elif condition == "=":
-            if quality_val == value:
-                match = True
-        elif condition == "<":
-            if quality_val < value:
-                match = True
-        #print(f"pot_bg {pot_bg_color} border {border} quality {quality_val} "
-        #      f"value {value} match {match}")
-        if match:
-            bg_color = pot_bg_color
-            if pot_fg_color != "":
-                fg_color = pot_fg_color
-            break
-    #print(f"quality_val {quality_val} condition {condition} value {value} "
-    #      f"bg_color {bg_color} pot {pot_bg_color}")
+    text = str(row[text_field].min())
+    bg_colors, fg_colors = rules.colors([quality_val])
+    labels = label_layout(np.array([[x0, y0, x1, y1]]), np.array([len(text)]))
+    return paint_leaf(svg, x0, y0, x1, y1, text, bg_colors[0], fg_colors[0],
+                      [values[0] for values in labels])
 
-    fill_style = {'fill': bg_color}
-    s = svg.plot_rect_mm(x0, y0, x1 - x0, y1 - y0, fill_style)
+class ColorRules(object):
+    """
+    The rule1..6, bg_color1..6 and fg_color1..6 of a macro row, compiled
+    once into threshold arrays; colors() then colours any number of cells
+    in one vectorized pass over their quality values
 
-    # Find out text to write in cell
-    text = row[text_field].min()
+    Rules are tried in order, the first match wins; an empty rule ends the
+    list, as an "else" catch-up clause. Without a match, the cell gets the
+    bg_color of the last rule and black text.
+    """
+
+    def __init__(self, borders):
+        if len(borders) == 0:
+            raise Exception("ColorRules: no bg_color given for any rule")
+        self.borders = borders
+        self.conditions = []
+        values = []
+        self.bg_colors = []
+        self.fg_colors = []
+        for limit_dict in borders:
+            rule = limit_dict['rule']
+            # last line is an "else" catch-up clause, if the value is empty
+            if rule == "":
+                break
+            self.conditions.append(rule[0])
+            values.append(float(rule[1:]))
+            self.bg_colors.append(limit_dict["bg_color"])
+            fg_color = limit_dict["fg_color"]
+            self.fg_colors.append("black" if fg_color == "" else fg_color)
+        self.values = np.array(values, dtype=float)
+        self.bg_colors.append(borders[-1]["bg_color"])
+        self.fg_colors.append("black")
+
+    def choose(self, quality_values):
+        """Index of the first matching rule for each value (no match: the
+        index after the last rule)"""
+        quality_values = np.asarray(quality_values, dtype=float)
+        choice = np.full(len(quality_values), len(self.conditions))
+        for i in range(len(self.conditions) - 1, -1, -1):
+            condition = self.conditions[i]
+            value = self.values[i]
+            if condition == ">":
+                choice[quality_values > value] = i
+            elif condition == "=":
+                choice[quality_values == value] = i
+            elif condition == "<":
+                choice[quality_values < value] = i
+        return choice
+
+    def colors(self, quality_values):
+        """Background and text colour lists for the quality values"""
+        choice = self.choose(quality_values).tolist()
+        return ([self.bg_colors[i] for i in choice],
+                [self.fg_colors[i] for i in choice])
+
+def label_layout(rects, text_lengths):
+    """
+    Font size, orientation and anchor point of the labels of many cells at
+    once: a label runs along the longer side of its cell, at most 24 pt and
+    at most 0.9 times the shorter side
+    :param rects: array of cell rectangles, one (x0, y0, x1, y1) per row
+    :param text_lengths: array of label lengths in characters
+    :return: lists of text size, max point size, angle, x and y per cell
+    """
+    x0, y0, x1, y1 = rects.T
     available_width = x1 - x0
     available_height = y1 - y0
     is_portrait = available_height > available_width
-    angle = (-90 if is_portrait else 0)
-    max_point_size = 0.9 * (available_width if is_portrait else available_height)
-    text = str(text)
-    text_width = len(text)
-    if text_width == 0:
+    angle = np.where(is_portrait, -90, 0)
+    max_point_size = 0.9 * np.where(is_portrait, available_width,
+                                    available_height)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.maximum(available_width, available_height) / text_lengths
+        fitted = 0.1 * np.trunc(14 * ratio)
+    text_size = np.minimum(max_point_size, np.minimum(24, fitted)).tolist()
+    # As min(max_point_size, min(24, ...)) did, a full size label is int 24
+    for i in np.flatnonzero((fitted >= 24) & (max_point_size > 24)):
+        text_size[i] = 24
+    return (text_size, max_point_size.tolist(), angle.tolist(),
+            (x0 + available_width / 2).tolist(),
+            (y0 + available_height / 2).tolist())
+
+def paint_leaf(svg, x0, y0, x1, y1, text, bg_color, fg_color, label):
+    """
+    SVG of one cell: its rectangle and its label
+    :param label: (text size, max point size, angle, x, y), from
+        label_layout()
+    """
+
+    fill_style = {'fill': bg_color}
+    s = svg.plot_rect_mm(x0, y0, x1 - x0, y1 - y0, fill_style)
+
+    # Find out text to write in cell
+    text_size, max_point_size, angle, x, y = label
+    if len(text) == 0:
         warning = f"text_width 0 for x0 {x0} y0 {y0} x1 {x1} y1 {y1}"
         s += svg.comment(warning)
         print(warning)
         return s
-    ratio = max(available_width / text_width, available_height / text_width)
-    text_size = min(max_point_size, min(24, 0.1 * int(14 * ratio)))
 
     text_style = {'font-size': text_size, 'text-anchor': "middle",
                   'dominant-baseline': "central", 'fill': fg_color}
     s += svg.comment(f"{text}: max_point_size {max_point_size:.2f} "
                      f"textsize {text_size}")
-    #s += svg.comment(f"- {text}: ratio {ratio:.2f} available width "
-    #                 f"{available_width:.2f}")
-    s += svg.plot_text_mm(x0 + available_width / 2, y0 + available_height / 2,
-                          text, text_style, angle=angle)
+    s += svg.plot_text_mm(x, y, text, text_style, angle=angle)
     #print(text)
     #row2 = row.values[0].astype(str)
     #row3 = map(str, row2)
@@ -233,39 +765,208 @@ def paint_cell(data, x0, y0, x1, y1, text_field, area, quality, borders):
     #print(f"bottom {row4} - ({x0:.2f}, {y0:.2f}) - ({x1:.2f}, {y1:.2f})")
     return s
 
-# Identify right input file
-parameter_given = len(sys.argv) > 1
-if parameter_given:
-    input_spreadsheet = sys.argv[1]
-else:
-    input_spreadsheet = "voronoi.xlsx"
-
-# Verify that the input file exists
-if not os.path.exists(input_spreadsheet):
-    print(f"voronoi.py error: Could not find input file {input_spreadsheet} "
-          f"(cwd = {os.getcwd()})")
-    sys.exit(0)
-else:
-    print(f"voronoi.py: Opening {input_spreadsheet} (cwd = {os.getcwd()})")
-
-# Verify that the Voronoi "macro" sheet exists
-macro = "Voronoi"
-xl = pd.ExcelFile(input_spreadsheet)
-sheet_names = xl.sheet_names
-if not macro in sheet_names:
-    print(f"voronoi.py error: Could not find sheet named '{macro}' in file "
-          f"{input_spreadsheet}")
-    sys.exit(0)
-
-cmds = pd.read_excel(input_spreadsheet, sheet_name=macro)
-cmds = cmds.replace(np.nan, '', regex=True)
-
-for index, row in cmds.iterrows():
-    active = row['active']
+def output_file(row):
+    """Output file of a macro row: .svgz is written gzipped, .png as a
+    raster preview, .tiles as a folder of tiles (see export_tiles()),
+    anything else gets .svg appended"""
+    output_svgfile = row['output_svgfile']
+    if not output_svgfile.endswith((".svgz", ".png", ".tiles")):
+        output_svgfile += ".svg"
+    return output_svgfile
+
+def row_files(row):
+    """Files a macro row writes besides its output file: the layout_file,
+    and for a folder of tiles its TILES_INDEX and every tile listed"""
+    layout_file = row.get('layout_file', "")
+    files = [layout_file] if layout_file else []
+    output = output_file(row)
+    if output.endswith(".tiles"):
+        path = os.path.join(output, TILES_INDEX)
+        files.append(path)
+        try:
+            with open(path) as f:
+                tiles = json.load(f)['tiles']
+        except (OSError, ValueError, KeyError):
+            tiles = []
+        files += [os.path.join(output, tile['file']) for tile in tiles]
+    return files
+
+def row_hash(workbook, row, *options):
+    """
+    Content hash of everything the output of a macro row depends on: the
+    row parameters, the used columns of the input sheet (or the bytes of
+    the .csv file), the colour sheet and the render options
+    :return: hex digest, or None if some input is missing
+    """
+    params = {field: str(value) for field, value in row.items()
+              if field != 'active'}
+    h = hashlib.sha1(json.dumps([params, options], sort_keys=True).encode())
     input_sheet = row['input_sheet']
-    if active == "#": # Commented out line, not to be executed
-        continue
-    output_svgfile = row['output_svgfile'] + ".svg"
+    levels = row['levels'].replace(" ", "").split(",")
+    csv_file = input_csv(workbook, input_sheet)
+    if csv_file is not None:
+        if not os.path.exists(csv_file):
+            return None
+        with open(csv_file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    elif input_sheet in workbook.sheet_names:
+        df = workbook.memo(('input', input_sheet), read_input, workbook,
+                           input_sheet)
+        cols = levels + [row['area'], row['quality']]
+        if not set(cols) <= set(df.columns):
+            return None
+        import pandas as pd
+        h.update(pd.util.hash_pandas_object(df[cols], index=False).values)
+    else:
+        return None
+    color_sheet = row['color_sheet']
+    if not color_sheet in workbook.sheet_names:
+        return None
+    colors = workbook.memo(('colors', color_sheet), read_colors, workbook,
+                           color_sheet)
+    h.update(json.dumps(sorted(colors.items(), key=str)).encode())
+    return h.hexdigest()
+
+class Manifest(object):
+    """
+    Record of the input hash behind each output file, kept in MANIFEST in
+    the folder of the outputs; a row whose hash is unchanged, and whose
+    output file and other files are still as they were written, need not
+    be rendered again
+    """
+
+    MANIFEST = ".voronoi_manifest.json"
+
+    def __init__(self):
+        self.entries = {}  # folder -> {file name: entry}
+
+    def folder(self, output):
+        folder = os.path.dirname(os.path.abspath(output))
+        if folder not in self.entries:
+            path = os.path.join(folder, self.MANIFEST)
+            try:
+                with open(path) as f:
+                    self.entries[folder] = json.load(f)
+            except (OSError, ValueError):
+                self.entries[folder] = {}
+        return self.entries[folder]
+
+    @staticmethod
+    def stat(files):
+        """{absolute path: [size, mtime_ns]} of files, None if one is
+        missing"""
+        stats = {}
+        for file in files:
+            try:
+                stat = os.stat(file)
+            except OSError:
+                return None
+            stats[os.path.abspath(file)] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    def is_current(self, output, digest):
+        entry = self.folder(output).get(os.path.basename(output))
+        if digest is None or entry is None or entry['hash'] != digest:
+            return False
+        try:
+            stat = os.stat(output)
+        except OSError:
+            return False
+        files = entry.get('files', {})
+        return (entry['size'] == stat.st_size and
+                entry['mtime_ns'] == stat.st_mtime_ns and
+                self.stat(files) == files)
+
+    def record(self, output, digest, files=()):
+        """
+        :param files: the other files the row wrote, which have to stay as
+            they are, too
+        """
+        entries = self.folder(output)
+        stats = self.stat(files)
+        if digest is None or not os.path.exists(output) or stats is None:
+            entries.pop(os.path.basename(output), None)
+            return
+        stat = os.stat(output)
+        entries[os.path.basename(output)] = {'hash': digest,
+                                             'size': stat.st_size,
+                                             'mtime_ns': stat.st_mtime_ns,
+                                             'files': stats}
+
+    def save(self):
+        for folder, entries in self.entries.items():
+            with lib.atomic_write(os.path.join(folder, self.MANIFEST)) as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+
+Rendering = collections.namedtuple('Rendering', 'index diagrams svg')
+
+def render(data, levels, area, quality, rules, colors=None, output=None,
+           layout="refine", precision=None, title="Voronoi Diagram",
+           min_cell_area=None, max_cells=None, cache=None):
+    """
+    Render the Voronoi diagrams of data in-process, one per level, as a
+    macro row does, without a workbook (the CLI only adds the macro sheet)
+    :param data: DataFrame, or dict of column arrays
+    :param rules: ColorRules, or list of {'rule', 'bg_color', 'fg_color'}
+        dicts, as the rule1..6, bg_color1..6 and fg_color1..6 of a row
+    :param colors: dict of colour names to hex colours, as read_colors()
+    :param output: file to write (.svg, .svgz or .png); None = return the
+        SVG document as text
+    :param precision: decimals of compact SVG output (None = plain SVG)
+    :param min_cell_area, max_cells: level of detail, see fold_index()
+    :param cache: kajtree.LayoutCache to reuse the layout from, if only the
+        colours, rules or quality changed
+    :return: Rendering(index, diagrams, svg): the HierarchyIndex (None for
+        layout "reference"), the (node, x0, y0, x1, y1) cells of each
+        diagram, and the SVG text (None if written to output)
+    """
+    if not isinstance(rules, ColorRules):
+        rules = ColorRules(rules)
+    svg = new_canvas(colors or {}, output or ".svg", precision)
+    index = df = None
+    if layout == "reference":
+        import pandas as pd
+        df = pd.DataFrame({c: data[c] for c in levels + [area, quality]})
+        df = df.replace(np.nan, '', regex=True)
+    else:
+        index = kajtree.HierarchyIndex([np.asarray(data[c]) for c in levels],
+                                       np.asarray(data[area]),
+                                       np.asarray(data[quality]))
+        index = fold_index(svg, title, index, levels, min_cell_area,
+                           max_cells)
+    diagrams = []
+    fragments = paint_document(svg, title, levels, area, quality, rules,
+                               layout, index, df, diagrams, verbose=False,
+                               cache=cache)
+    if output is None:
+        return Rendering(index, diagrams, "".join(fragments))
+    svg.save_as(output, fragments)
+    return Rendering(index, diagrams, None)
+
+def new_canvas(colors, output, precision=None):
+    """SVG, or Raster for a .png output, compact if precision is given"""
+    if output.endswith(".png"):
+        svg = kajsvg.Raster(colors)
+    else:
+        svg = kajsvg.SVG(colors)
+    if precision is not None:
+        svg.set_compact(precision)
+    return svg
+
+def render_row(workbook, index, row, layout="refine", precision=None,
+               cache=None, csv_reader="csv"):
+    """
+    Render one active row of the Voronoi macro sheet into its output file
+    :param precision: decimals of compact SVG output (None = plain SVG)
+    :param cache: kajtree.LayoutCache of the layouts made before
+    :param csv_reader: reader of .csv inputs, see hierarchy_index()
+    :return: True if the file was written, False if the row was skipped
+    """
+    input_spreadsheet = workbook.filename
+    sheet_names = workbook.sheet_names
+    input_sheet = row['input_sheet']
+    output_svgfile = output_file(row)
     levelstr = row['levels']
     levels = levelstr.replace(" ", "").split(",")
     area = row['area']
@@ -287,30 +988,229 @@ for index, row in cmds.iterrows():
         print(f"voronoi.py error: Could not find color_sheet '{color_sheet}' "
               f"in file {input_spreadsheet} (row = {input_sheet})")
         print("- Skipping this row")
-        continue
+        return False
 
-    colors = pd.read_excel(input_spreadsheet, sheet_name=color_sheet)
-    _colors ={}
-    for i, r in colors.iterrows():
-        c1 = r['color']
-        c2 = r['pf_color']
-        hex = r['hex']
-        _colors[c1] = hex
-        _colors[c2] = hex
-    svg = kajsvg.SVG(_colors)
+    _colors = workbook.memo(('colors', color_sheet), read_colors, workbook,
+                            color_sheet)
+    svg = new_canvas(_colors, output_svgfile, precision)
 
     # Check that input datasheet exists
-    if not input_sheet in sheet_names:
+    csv_file = input_csv(workbook, input_sheet)
+    if csv_file is not None:
+        if not os.path.exists(csv_file):
+            print(f"voronoi.py error: Missing input file '{input_sheet}' "
+                  f"next to {input_spreadsheet}")
+            print("- Skipping this row")
+            return False
+    elif not input_sheet in sheet_names:
         print(f"voronoi.py error: Missing input_sheet '{input_sheet}' "
               f"in file {input_spreadsheet}")
         print("- Skipping this row")
-        continue
+        return False
+
+    rules = ColorRules(borders)
+    if output_svgfile.endswith(".tiles"):
+        # Tile pyramid, in the optional tile_format (default svg)
+        if not has_columns(workbook, input_sheet, levels, area, quality):
+            print("- skipping this row")
+            return False
+        tile_format = row.get('tile_format', "") or "svg"
+        index = hierarchy_index(workbook, input_sheet, levels, area, quality,
+                                csv_reader)
+        with lib.tracer.span("tiles", output=output_svgfile):
+            tiles = export_tiles(index, output_svgfile, rules, _colors,
+                                 tile_format, precision=precision,
+                                 title=f"Voronoi Diagram for {input_sheet}")
+        print(f"\n{lib.i1000(tiles)} tiles saved into folder "
+              f"{output_svgfile}")
+        return tiles > 0
+
+    # Optional level of detail columns
+    min_cell_area = row.get('min_cell_area', "")
+    min_cell_area = float(min_cell_area) if min_cell_area != "" else None
+    max_cells = row.get('max_cells', "")
+    max_cells = int(float(max_cells)) if max_cells != "" else None
+    # Optional layout table file
+    layout_file = row.get('layout_file', "")
+    fragments = tree_paint(svg, workbook, input_sheet, levels, area, quality,
+                           rules, layout, min_cell_area, max_cells,
+                           layout_file, cache, csv_reader)
+    with lib.tracer.span("render", output=output_svgfile):
+        return svg.save_as(output_svgfile, fragments, verbose=True) > 0
+
+def init_worker(workbook, trace=False, cache=None, csv_reader="csv"):
+    global _workbook, _layout_cache, _csv_reader
+    _workbook = workbook
+    _layout_cache = cache
+    _csv_reader = csv_reader
+    lib.tracer.drain()  # Forked workers start with a copy of the events
+    lib.tracer.enable(trace)
+
+def render_row_logged(task):
+    """
+    render_row() with its console output captured, for worker processes;
+    a failing row prints its traceback into the log instead of raising
+    :return: (True if the file was written, console output, trace events)
+    """
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            ok = render_row(_workbook, *task, cache=_layout_cache,
+                            csv_reader=_csv_reader)
+        except Exception:
+            traceback.print_exc(file=log)
+            ok = False
+    return ok, log.getvalue(), lib.tracer.drain()
+
+def main():
+    # Identify right input file
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("input_spreadsheet", nargs="?",
+                        default="voronoi.xlsx")
+    parser.add_argument("--layout", choices=["refine", "array", "reference"],
+                        default="refine",
+                        help="refine: NumPy layout engine, each diagram "
+                             "refining the one above (default); array: NumPy "
+                             "layout of each diagram from scratch; reference: "
+                             "the original recursive DataFrame split, for "
+                             "comparing the rectangles")
+    parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N",
+                        help="render the macro rows in N worker processes; "
+                             "the console output stays in row order")
+    parser.add_argument("--compact", type=int, nargs="?", const=2,
+                        metavar="DECIMALS",
+                        help="compact SVG: shared CSS classes instead of "
+                             "inline styles, no comments, coordinates with "
+                             "DECIMALS decimals (default 2)")
+    parser.add_argument("--csv-reader", choices=["csv", "pandas"],
+                        default="csv",
+                        help="reader of .csv inputs: csv, the standard "
+                             "library module (default, no pandas import); "
+                             "pandas, chunked pandas.read_csv, faster on "
+                             "large files")
+    parser.add_argument("--force", action="store_true",
+                        help="render all rows, also those whose inputs are "
+                             "unchanged since their output was written")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="time the stages of each row into FILE, a "
+                             "Chrome trace-event JSON file (chrome://tracing"
+                             ", Perfetto), and print a summary")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="parse the workbook and lay out the diagrams "
+                             "without using or filling the on-disk sheet and "
+                             "layout caches (see kajlib.SheetCache, which "
+                             "needs pyarrow, and kajtree.LayoutCache)")
+    args = parser.parse_args()
+    input_spreadsheet = args.input_spreadsheet
+    lib.tracer.enable(args.trace is not None)
+
+    # Verify that the input file exists
+    if not os.path.exists(input_spreadsheet):
+        print(f"voronoi.py error: Could not find input file "
+              f"{input_spreadsheet} (cwd = {os.getcwd()})")
+        sys.exit(0)
+    else:
+        print(f"voronoi.py: Opening {input_spreadsheet} "
+              f"(cwd = {os.getcwd()})")
+
+    # Verify that the Voronoi "macro" sheet exists
+    macro = "Voronoi"
+    if input_spreadsheet.lower().endswith(".csv"):
+        # The macro sheet as .csv, next to the .csv sheets it refers to
+        workbook = lib.CsvWorkbook(input_spreadsheet, macro)
+    else:
+        workbook = lib.Workbook(input_spreadsheet,
+                                cache=False if args.no_cache else None)
+    if not macro in workbook.sheet_names:
+        print(f"voronoi.py error: Could not find sheet named '{macro}' in "
+              f"file {input_spreadsheet}")
+        sys.exit(0)
+
+    cmds = workbook.sheet(macro)
+    layout_cache = None
+    if not args.no_cache and os.environ.get("KAJ_LAYOUT_CACHE") != "off":
+        layout_cache = kajtree.LayoutCache()
+
+    # Collect the columns each sheet is needed for, to parse them all once
+    tasks = []
+    for index, row in records(cmds):
+        if row['active'] == "#": # Commented out line, not to be executed
+            continue
+        levels = row['levels'].replace(" ", "").split(",")
+        workbook.need(row['input_sheet'],
+                      levels + [row['area'], row['quality']])
+        workbook.need(row['color_sheet'], ['color', 'pf_color', 'hex'])
+        tasks.append((index, row, args.layout, args.compact))
+
+    # Skip the rows whose inputs are the same as when their output was made
+    manifest = Manifest()
+    digests = {}
+    for task in list(tasks):
+        index, row = task[:2]
+        output = output_file(row)
+        digests[index] = row_hash(workbook, *task[1:])
+        if not args.force and manifest.is_current(output,
+                                                  digests[index]):
+            print(f"\n{index}. {output}: inputs unchanged, skipping "
+                  f"(--force renders it anyway)")
+            tasks.remove(task)
+
+    # Rows run one by one, or in a process pool which hands back each
+    # row's output in row order, whichever row happens to finish first.
+    # A worker that dies (killed for memory, crashed) breaks the pool: the
+    # rows it takes down with it fail, those done before keep their output
+    failed = []
+    if args.jobs > 1 and len(tasks) > 1:
+        workbook.load()
+        with concurrent.futures.ProcessPoolExecutor(
+                args.jobs, initializer=init_worker,
+                initargs=(workbook, lib.tracer.enabled, layout_cache,
+                          args.csv_reader)) as pool:
+            futures = [pool.submit(render_row_logged, task)
+                       for task in tasks]
+            for task, future in zip(tasks, futures):
+                try:
+                    ok, log, trace = future.result()
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    ok, trace = False, ([], {})
+                    output = output_file(task[1])
+                    log = (f"\n{task[0]}. {output}: failed, a worker "
+                           f"process died ({e})\n")
+                    # The temporary file of the dead writer, if any
+                    for temp in glob.glob(glob.escape(output) + ".*.tmp"):
+                        with contextlib.suppress(OSError):
+                            os.remove(temp)
+                sys.stdout.write(log)
+                lib.tracer.extend(trace)
+                if not ok:
+                    failed.append(task[0])
+                manifest.record(output_file(task[1]),
+                                digests[task[0]] if ok else None,
+                                row_files(task[1]))
+    else:
+        for task in tasks:
+            try:
+                ok = render_row(workbook, *task, cache=layout_cache,
+                                csv_reader=args.csv_reader)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                ok = False
+            if not ok:
+                failed.append(task[0])
+            manifest.record(output_file(task[1]),
+                            digests[task[0]] if ok else None,
+                            row_files(task[1]))
+    manifest.save()
 
-    svg_str = tree_paint(input_spreadsheet, input_sheet, levels, area, quality,
-                         borders)
+    if args.trace:
+        lib.tracer.save_chrome_trace(args.trace)
+        print("\n" + lib.tracer.report())
+        print(f"voronoi.py: trace saved into {args.trace}")
 
-    print("")
+    if failed:
+        print(f"voronoi.py: {len(failed)} of {len(tasks)} rows failed "
+              f"(rows {', '.join(str(i) for i in failed)})")
+        sys.exit(1)
 
-    got_valid_svg_file = (len(svg_str) > 0)
-    if got_valid_svg_file :
-        lib.save_as(output_svgfile, svg_str, verbose=True)
\ No newline at end of file
+if __name__ == "__main__":
+    main()